@@ -1,52 +1,185 @@
+import sys
+
+if __name__ == "__main__" and len(sys.argv) > 1:
+    # Reports and maintenance from the command line never load tkinter
+    import fmscli
+    sys.exit(fmscli.main(sys.argv[1:]))
+
 from tkinter import *
 from tkinter.messagebox import showinfo, askquestion
 from tkinter.simpledialog import askstring
 from tkinter.scrolledtext import ScrolledText
 from tkinter import font
 from tkinter import ttk
+from tkinter import filedialog
 import sqlite3
+import threading
+import functools
+import json
 import os
 import platform
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, date, timedelta
 
+import fmsdb
+from fmsdb import (COMPLETION_COLUMNS, GROUPS, Pager, RowSource, TABLES,
+    date_range_query, manager, migrate, month_bounds, parse_date,
+    query_stats, search_query, sort_key, summary_query, write_rows,
+    year_bounds)
+
 icon = os.path.abspath('./fms.ico')
 
+# Where records are read and saved: fmsdb itself, or a fmsserver.Client
+# with the same functions when FMS_SERVER names a server
+db = fmsdb
 
-class Connection:
-    def __init__(self):
-        self.conn = sqlite3.connect("fms.db")
+EXPORT_TYPES = [("CSV files", "*.csv"), ("JSON Lines", "*.jsonl")]
 
-    def __enter__(self):
-        return self.conn
 
-    def __exit__(self, exec_type, exec_val, tb):
-        if exec_type:
-            self.conn.rollback()
-        else:
-            self.conn.commit()
+# Registers longer than this, and all RowSources, are shown through a
+# window of widget rows that is refilled as the user scrolls
+VIRTUAL_ROWS = 1000
+
+# Rows prefetched beyond the visible window
+ROW_BUFFER = 50
+
+# A query view left this long without scrolling gives up its read
+IDLE_MS = 2000
+
+# Rows measured when sizing columns
+WIDTH_SAMPLE = 100
+
+# Actions listed under Recent on the status bars
+STATUS_HISTORY = 20
+
+
+def process_memory():
+    # Resident memory of this process in bytes, None if it cannot be read
+    if platform.system() == "Windows":
+        import ctypes
+        from ctypes import wintypes
+
+        class Counters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                ("PageFaultCount", wintypes.DWORD)] + [(name, ctypes.c_size_t)
+                for name in ("PeakWorkingSetSize", "WorkingSetSize",
+                "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage",
+                "PagefileUsage", "PeakPagefileUsage")]
 
-        self.conn.close()
+        counters = Counters()
+        counters.cb = ctypes.sizeof(counters)
+        if ctypes.windll.psapi.GetProcessMemoryInfo(
+                ctypes.windll.kernel32.GetCurrentProcess(),
+                ctypes.byref(counters), counters.cb):
+            return counters.WorkingSetSize
+        return None
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+class Performance:
+    # What recent actions cost: time spent in SQLite, rows fetched and
+    # time spent filling Treeviews. Shown on the status bars.
+    def __init__(self):
+        self.history = deque(maxlen=STATUS_HISTORY)
+        self.rendered = 0.0
+        self.bars = []
+        self.visible = False
+
+    def begin(self, name):
+        # The counters as the action starts, for end() to subtract
+        return (name,) + query_stats.thread_totals() + (self.rendered,)
+
+    def end(self, action, seconds=0.0, rows=0):
+        # seconds and rows are query work done for it on another thread
+        name, queried, fetched, rendered = action
+        now_queried, now_fetched = query_stats.thread_totals()
+        entry = (time.strftime("%H:%M:%S"), name,
+            now_queried - queried + seconds, now_fetched - fetched + rows,
+            self.rendered - rendered, process_memory())
+        self.history.append(entry)
+        for bar in self.bars:
+            bar.show(entry)
+
+    def describe(self, entry):
+        when, name, seconds, rows, rendered, memory = entry
+        return "%s %s: query %.1f ms, %s rows, render %.1f ms, memory %s" % (
+            when, name, seconds * 1000, rows, rendered * 1000,
+            "%.1f MB" % (memory / 1048576) if memory else "-")
+
+    def show_bars(self, visible):
+        self.visible = visible
+        for bar in self.bars:
+            bar.display()
+
+
+performance = Performance()
+
+
+def measured(name):
+    # Records what the decorated action cost on the status bars
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(*args, **kwargs):
+            action = performance.begin(name)
+            try:
+                return method(*args, **kwargs)
+            finally:
+                performance.end(action)
+        return wrapper
+    return decorate
 
 
 class Treeview(ttk.Treeview):
+    _font = None
+
     def __init__(self, parent, headers, parent_self, *args, **kwargs):
         ttk.Treeview.__init__(self, parent,  columns = headers, show="headings", height=2, *args, **kwargs)
 
-        vsb = ttk.Scrollbar(parent, orient="vertical", command=self.yview)
+        self.vsb = ttk.Scrollbar(parent, orient="vertical", command=self.yview)
         hsb = ttk.Scrollbar(parent, orient="horizontal", command=self.xview)
-        self.configure(yscrollcommand=vsb.set, xscrollcommand=hsb.set)
-        vsb.pack(side='right', fill="y", anchor='w')
+        self.configure(yscrollcommand=self.vsb.set, xscrollcommand=hsb.set)
+        self.vsb.pack(side='right', fill="y", anchor='w')
         hsb.pack(side='bottom', fill="x")
 
         self.parent = parent
         self.headers = headers
-        self.current_selection = None
+        self.register = None
+        self.row_ids = []
+        self.shown = {}
+        self.virtual = False
+        self.offset = 0
+        self.window_rows = 20
+        self.idle = None
+        # Set when the rows are one page of a larger list
+        self.pager = None
+        # BusyBar showing sorts of query results, with their Cancel
+        self.busy = None
         self.parent_self= parent_self
         self.bind("<<TreeviewSelect>>", self.get_selection)
+        self.bind("<Configure>", self.on_resize)
+        self.bind("<Destroy>", self.on_destroy)
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.bind(sequence, self.on_wheel)
+        for sequence in ("<Up>", "<Down>", "<Prior>", "<Next>"):
+            self.bind(sequence, self.on_key)
         self._build_tree()
 
     def set_headers(self, headers):
+        # Columns are rebuilt only when they actually change
+        headers = list(headers)
+        if headers == list(self.headers):
+            return
+        self.clear()
         self.headers = headers
+        self.configure(columns=headers)
+        self._build_tree()
 
     def _build_tree(self):
         for col in self.headers:
@@ -55,50 +188,431 @@ class Treeview(ttk.Treeview):
             self.column(col, anchor='nw', width=100)
 
     def sortby(self, tree, col, descending):
-        data = [(tree.set(child, col), child) for child in tree.get_children('')]
-        data.sort(reverse=descending)
-        for ix, item in enumerate(data):
-            tree.move(item[1], '', ix)
+        ix = self.headers.index(col)
+
+        if isinstance(self.register, RowSource):
+            # Let SQLite order it, using an index where there is one. It
+            # runs the query again, so off the Tk thread.
+            register = self.register
+            BackgroundQuery(self, lambda: register.sorted(
+                register.columns[ix], descending), self.set_register,
+                self.busy, "Sorting...", action="Sort")
+        elif self.register:
+            self.sort_rows(ix, descending)
+
         tree.heading(col, command=lambda col=col: self.sortby(tree, col, int(not descending)))
 
+    @measured("Sort")
+    def sort_rows(self, ix, descending):
+        # Sorts a typed copy of the rows in memory
+        started = time.perf_counter()
+        order = sorted(range(len(self.register)), reverse=descending,
+            key=lambda i: sort_key(self.register[i][ix]))
+        self.register = [self.register[i] for i in order]
+
+        if self.virtual:
+            self.offset = 0
+            self.render_window()
+        else:
+            # Reorder the existing rows in one call
+            self.row_ids = [self.row_ids[i] for i in order]
+            self.set_children('', *self.row_ids)
+        performance.rendered += time.perf_counter() - started
+
+    @classmethod
+    def measure(cls, text):
+        # One Font for every measurement; creating one is expensive
+        if cls._font is None:
+            cls._font = font.Font()
+        return cls._font.measure(text)
+
+    def fit_columns(self, rows):
+        # Widen columns to fit a sample of rows rather than every row
+        widths = [self.column(col, width=None) for col in self.headers]
+        try:
+            for item in rows:
+                for ix, val in enumerate(item):
+                    widths[ix] = max(widths[ix], self.measure(val))
+        except TypeError:
+            raise TypeError("Tree_list must be a list of tuples")
+
+        for col, width in zip(self.headers, widths):
+            self.column(col, width=width)
+
     def fill_tree(self):
-        # Delete children and repopulate
-        self.delete(*self.get_children())
+        if self.register is None:
+            self.clear()
+            return
 
-        if self.register is not None:
-            for item in self.register:
-                self.insert('', 'end', values=item)  # Returns row-id
-                # adjust column's width if necessary to fit each value
-                try:
-                    for ix, val in enumerate(item):
-                        col_w = font.Font().measure(val)
-                        if self.column(self.headers[ix], width=None) < col_w:
-                            self.column(self.headers[ix], width=col_w)
-                except TypeError:
-                    raise TypeError("Tree_list must be a list of tuples")
+        self.fit_columns(self.register[:WIDTH_SAMPLE])
+
+        if self.virtual:
+            self.configure(yscrollcommand="")
+            self.vsb.configure(command=self.scroll_window)
+            self.render_window()
+        else:
+            self.configure(yscrollcommand=self.vsb.set)
+            self.vsb.configure(command=self.yview)
+            self.merge_rows()
+
+    def merge_rows(self):
+        # Rows already on screen keep their widget item; only new rows
+        # are inserted and only vanished ones deleted
+        reusable = {}
+        for iid, row in self.shown.items():
+            reusable.setdefault(row, []).append(iid)
+
+        self.row_ids = []
+        self.shown = {}
+        for row in self.register:
+            row = tuple(row)
+            if reusable.get(row):
+                iid = reusable[row].pop()
+            else:
+                iid = self.insert('', 'end', values=row)
+            self.row_ids.append(iid)
+            self.shown[iid] = row
+
+        stale = [iid for iids in reusable.values() for iid in iids]
+        if stale:
+            self.delete(*stale)
+        self.set_children('', *self.row_ids)
+
+    def row_count(self):
+        # Rows known so far; a RowSource still being read reports one
+        # batch more so the scrollbar leaves room to scroll on
+        count = len(self.register)
+        if isinstance(self.register, RowSource) and not self.register.exhausted:
+            count += self.register.batch
+        return count
+
+    def render_window(self):
+        if isinstance(self.register, RowSource):
+            self.register.fetch(self.offset + self.window_rows + ROW_BUFFER)
+            self.pause_later()
+
+        self.offset = max(0, min(self.offset, len(self.register) - self.window_rows))
+        rows = self.register[self.offset:self.offset + self.window_rows]
+        items = self.get_children()
+
+        # Reuse the widget rows, only adding or removing at the end
+        for iid, row in zip(items, rows):
+            if self.shown.get(iid) != row:
+                self.item(iid, values=row)
+                self.shown[iid] = row
+        if len(items) > len(rows):
+            self.delete(*items[len(rows):])
+            for iid in items[len(rows):]:
+                self.shown.pop(iid, None)
+        for row in rows[len(items):]:
+            self.shown[self.insert('', 'end', values=row)] = row
+
+        # The rows now shown belong to other records
+        self.selection_set(())
+
+        total = max(self.row_count(), 1)
+        self.vsb.set(self.offset / total, (self.offset + len(rows)) / total)
+
+    def scroll_window(self, action, amount, unit=None):
+        if action == "moveto":
+            self.offset = int(float(amount) * self.row_count())
+        elif unit == "pages":
+            self.offset += int(amount) * self.window_rows
+        else:
+            self.offset += int(amount)
+        self.render_window()
+
+    def on_wheel(self, event):
+        if not self.virtual:
+            return
+        if event.num == 4 or event.delta > 0:
+            self.scroll_window("scroll", -3)
+        else:
+            self.scroll_window("scroll", 3)
+        return "break"
+
+    def on_key(self, event):
+        # Arrowing or paging past the edge of the window moves the window
+        if not self.virtual:
+            return
+        items = self.get_children()
+        if not items:
+            return
+        focus = self.focus()
+        step = {"Up": -1, "Down": 1, "Prior": -self.window_rows,
+            "Next": self.window_rows}[event.keysym]
+        position = items.index(focus) if focus in items else 0
+
+        if 0 <= position + step < len(items):
+            return
+
+        self.scroll_window("scroll", step)
+        items = self.get_children()
+        target = items[0] if step < 0 else items[-1]
+        self.focus(target)
+        self.selection_set(target)
+        return "break"
+
+    def on_resize(self, event):
+        if not self.virtual:
+            return
+        rowheight = ttk.Style().lookup("Treeview", "rowheight") or 20
+        rows = max(1, event.height // int(rowheight) - 1)
+        if rows != self.window_rows:
+            self.window_rows = rows
+            self.render_window()
+
+    def pause_later(self):
+        if self.idle:
+            self.after_cancel(self.idle)
+        self.idle = self.after(IDLE_MS, self.pause_register)
+
+    def pause_register(self):
+        self.idle = None
+        if isinstance(self.register, RowSource):
+            self.register.pause()
+
+    def on_destroy(self, event):
+        if event.widget is not self:
+            return
+        if self.idle:
+            self.after_cancel(self.idle)
+        if isinstance(self.register, RowSource):
+            self.register.close()
 
     def get_selection(self, event=None):
         if event:
-            current_selection = event.widget.focus()
-            rows = self.item(current_selection)['values']
-            self.current_selection = rows
-            if hasattr(self.parent_self, 'Find'):
-                self.parent_self.Find(REF = rows[0])
+            selected = self.selection()
+            if not selected or selected[0] not in self.shown:
+                return
+            # The loaded row, not item() values, which Tk has retyped
+            row = self.shown[selected[0]]
+            if hasattr(self.parent_self, 'show_record'):
+                self.parent_self.show_record(self, row)
 
     def set_register(self, register):
+        if isinstance(self.register, RowSource) and register is not self.register:
+            self.register.close()
+
         self.register = register
+        self.offset = 0
+        self.virtual = isinstance(register, RowSource) or (
+            register is not None and len(register) > VIRTUAL_ROWS)
         self.update_tree()
 
     def update_tree(self):
-        self.clear()
+        started = time.perf_counter()
         self.fill_tree()
+        performance.rendered += time.perf_counter() - started
 
     def clear(self):
         self.delete(*self.get_children())
+        self.row_ids = []
+        self.shown = {}
 
     def get_all(self):
         return [item for item in self.get_children()]
 
+    def export(self, path, progress=None):
+        if self.pager is not None:
+            return self.pager.export(path, progress)
+        if isinstance(self.register, RowSource):
+            return self.register.export(path, progress)
+        return write_rows(self.headers, [self.register or []], path, progress)
+
+    def Export(self, busy=None):
+        path = filedialog.asksaveasfilename(title="Export",
+            defaultextension=".csv", filetypes=EXPORT_TYPES)
+        if not path:
+            return
+
+        status = {"text": "Exporting..."}
+        started = time.perf_counter()
+
+        def progress(count):
+            status["text"] = "Exported %s rows" % count
+
+        def done(count):
+            showinfo("Export", "Wrote %s rows to %s in %.1f s" % (
+                count, path, time.perf_counter() - started))
+
+        BackgroundQuery(self, lambda: self.export(path, progress), done,
+            busy, "Exporting...", lambda: status["text"], "Export")
+
+
+# Threads that run queries for the GUI; each keeps its own connection
+query_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="fms-query")
+
+
+class BackgroundQuery:
+    # Runs work() on the query pool and hands its result to done() on the
+    # Tk thread, which polls for it with after() rather than blocking.
+    POLL_MS = 50
+
+    def __init__(self, widget, work, done, busy=None, text="Searching...",
+            progress=None, action=None, failed=None):
+        self.widget = widget
+        self.work = work
+        self.done = done
+        # Called with the exception, cancellation included, in place of
+        # the usual message
+        self.failed = failed
+        self.busy = busy
+        self.progress = progress
+        self.cancelled = False
+        self.connections = []
+        self._lock = threading.Lock()
+        # Named actions are shown on the status bars when done
+        self.action = action and performance.begin(action)
+        self.queried = (0.0, 0)
+
+        if busy:
+            busy.start(self, text)
+        self.future = query_pool.submit(self.run)
+        widget.after(self.POLL_MS, self.poll)
+
+    def run(self):
+        if db is fmsdb:
+            self.watch(manager.get())
+        manager.local.job = self
+        queried, fetched = query_stats.thread_totals()
+        try:
+            return self.work()
+        finally:
+            manager.local.job = None
+            seconds, rows = query_stats.thread_totals()
+            self.queried = (seconds - queried, rows - fetched)
+
+    def watch(self, conn):
+        # Connections the work uses, so cancel() can interrupt them
+        with self._lock:
+            self.connections.append(conn)
+            if self.cancelled:
+                conn.interrupt()
+
+    def cancel(self):
+        with self._lock:
+            self.cancelled = True
+            for conn in self.connections:
+                conn.interrupt()
+
+    def poll(self):
+        if not self.future.done():
+            # progress() describes how far the work has got
+            if self.progress and self.busy and self.busy.job is self:
+                self.busy.label['text'] = self.progress()
+            self.widget.after(self.POLL_MS, self.poll)
+            return
+
+        # The window may have been closed while the query ran
+        try:
+            alive = self.widget.winfo_exists()
+        except TclError:
+            alive = False
+
+        if alive and self.busy:
+            self.busy.stop(self)
+
+        try:
+            value = self.future.result()
+        except Exception as e:
+            interrupted = isinstance(e, sqlite3.OperationalError) and self.cancelled
+            if alive and self.failed:
+                self.failed(e)
+            elif alive and not interrupted:
+                showinfo("Lookup Error", str(e))
+            return
+
+        if self.cancelled or not alive:
+            if isinstance(value, RowSource):
+                value.close()
+            return
+        self.done(value)
+        if self.action:
+            performance.end(self.action, *self.queried)
+
+
+class BusyBar(Frame):
+    # "Searching..." line with a Cancel button, shown while a
+    # BackgroundQuery runs
+    def __init__(self, parent, **kwargs):
+        super().__init__(parent, **kwargs)
+        self.job = None
+        self.label = Label(self, text="", fg='blue', font='Calibri 11')
+        self.label.pack(side=LEFT, padx=4)
+        self.progress = ttk.Progressbar(self, mode='indeterminate', length=120)
+        self.cancel = ttk.Button(self, text="Cancel", command=self.Cancel)
+
+    def start(self, job, text):
+        # A new query replaces the one still running
+        if self.job:
+            self.job.cancel()
+        self.job = job
+        self.label['text'] = text
+        self.progress.pack(side=LEFT, padx=4)
+        self.cancel.pack(side=LEFT, padx=4)
+        self.progress.start(10)
+
+    def stop(self, job):
+        if job is not self.job:
+            return
+        self.job = None
+        self.progress.stop()
+        self.progress.pack_forget()
+        self.cancel.pack_forget()
+        self.label['text'] = "Cancelled" if job.cancelled else ""
+
+    def Cancel(self):
+        if self.job:
+            self.job.cancel()
+
+
+def write_error(e):
+    # Other computers held the database through every retry
+    if isinstance(e, sqlite3.OperationalError) and fmsdb.busy(e):
+        return ("The database is busy with changes from another computer."
+            " Please try again.")
+    return str(e)
+
+
+class StatusBar(Frame):
+    # The cost of the last action, with the ones before it under Recent.
+    # Packed at the bottom of parent, ahead of the widget before, while
+    # the status bars are switched on.
+    def __init__(self, parent, before, **kwargs):
+        super().__init__(parent, relief='sunken', bd=1, **kwargs)
+        self.before = before
+        self.label = Label(self, text="", anchor='w', font='Calibri 10')
+        self.label.pack(side=LEFT, fill=X, expand=1, padx=4)
+        recent = ttk.Menubutton(self, text="Recent")
+        self.menu = Menu(recent, tearoff=0, postcommand=self.fill_menu)
+        recent['menu'] = self.menu
+        recent.pack(side=RIGHT)
+
+        performance.bars.append(self)
+        self.bind("<Destroy>", self.on_destroy)
+        if performance.history:
+            self.show(performance.history[-1])
+        self.display()
+
+    def display(self):
+        if performance.visible:
+            self.pack(side=BOTTOM, fill=X, before=self.before)
+        else:
+            self.pack_forget()
+
+    def show(self, entry):
+        self.label['text'] = performance.describe(entry)
+
+    def fill_menu(self):
+        self.menu.delete(0, END)
+        for entry in reversed(performance.history):
+            self.menu.add_command(label=performance.describe(entry))
+
+    def on_destroy(self, event):
+        if event.widget is self and self in performance.bars:
+            performance.bars.remove(self)
+
 
 class Dialog(Toplevel):
     def __init__(self, title):
@@ -165,12 +679,99 @@ class MyScrolledText(ScrolledText):
 
 
 
+class Autocomplete:
+    # Drops down the recorded values that start with what has been typed
+    # into an entry. Down moves into the list; Return or a click picks.
+    ignore = ("Up", "Down", "Return", "Escape", "Tab", "Shift_L", "Shift_R",
+        "Control_L", "Control_R", "Alt_L", "Alt_R")
+
+    def __init__(self, entry, column):
+        self.entry = entry
+        self.column = column
+        self.popup = None
+        entry.bind("<KeyRelease>", self.on_key, add="+")
+        entry.bind("<Down>", self.on_down, add="+")
+        entry.bind("<Escape>", self.hide, add="+")
+        entry.bind("<FocusOut>", self.on_focus_out, add="+")
+
+    def on_key(self, event):
+        if event.keysym in self.ignore:
+            return
+        text = self.entry.get()
+        try:
+            matches = db.complete(self.column, text) if text.strip() else []
+        except (sqlite3.Error, OSError):
+            # Typing goes on without suggestions
+            matches = []
+        if not matches or matches == [text]:
+            self.hide()
+        else:
+            self.show(matches)
+
+    def show(self, matches):
+        if self.popup is None:
+            self.popup = Toplevel(self.entry)
+            self.popup.overrideredirect(True)
+            self.listbox = Listbox(self.popup, font='Consolas 12',
+                width=self.entry.cget("width"), background='honeydew')
+            self.listbox.pack(expand=1, fill=BOTH)
+            self.listbox.bind("<ButtonRelease-1>", self.accept)
+            self.listbox.bind("<Return>", self.accept)
+            self.listbox.bind("<Escape>", self.hide)
+            self.listbox.bind("<FocusOut>", self.on_focus_out)
+
+        self.listbox.delete(0, END)
+        self.listbox.insert(END, *matches)
+        self.listbox.configure(height=len(matches))
+        self.popup.geometry("+%d+%d" % (self.entry.winfo_rootx(),
+            self.entry.winfo_rooty() + self.entry.winfo_height()))
+
+    def on_down(self, event):
+        if self.popup is None:
+            return
+        self.listbox.focus_set()
+        self.listbox.selection_set(0)
+        self.listbox.activate(0)
+        return "break"
+
+    def accept(self, event=None):
+        selected = self.listbox.curselection()
+        if selected:
+            self.entry.delete(0, END)
+            self.entry.insert(0, self.listbox.get(selected[0]))
+            self.entry.icursor(END)
+        self.hide()
+        self.entry.focus_set()
+
+    def on_focus_out(self, event):
+        # Focus passing between the entry and its list keeps the list
+        self.entry.after(50, self.hide_unless_focused)
+
+    def hide_unless_focused(self):
+        try:
+            focus = self.entry.focus_get()
+        except (KeyError, TclError):
+            focus = None
+        if self.popup is None or focus not in (self.entry, self.listbox):
+            self.hide()
+
+    def hide(self, event=None):
+        if self.popup is not None:
+            self.popup.destroy()
+            self.popup = None
+
+
 class Base:
     fields = []
 
     def build_toolbar(self, parent):
         self.toolbar = Frame(parent)
         self.toolbar.pack(padx=80,fill=X, pady=10, side=BOTTOM)
+        self.busy = BusyBar(parent)
+        self.busy.pack(padx=80, fill=X, side=BOTTOM)
+        # Imports have a bar of their own so a search does not cancel one
+        self.import_busy = BusyBar(parent)
+        self.import_busy.pack(padx=80, fill=X, side=BOTTOM)
 
     def add_tool_buttons(self):
         self.buttons = {}
@@ -220,123 +821,73 @@ class Base:
 
             key = field.upper().replace(" ", "_")
             self.entries[key] = entry
+            if key in COMPLETION_COLUMNS:
+                Autocomplete(entry, key)
 
-    def Save(self):
+    @property
+    def queries(self):
+        return TABLES[self.table].queries
+
+    def form_values(self, strip=False):
         values = []
         for ent in self.entries.values():
             try:
-                values.append(ent.get().strip())
+                value = ent.get()
             except TclError:
-                pass
+                continue
+            values.append(value.strip() if strip else value)
+        return tuple(values)
 
-        values = tuple(values)
-        keys = ", ".join([f.upper().replace(" ", "_") for f in self.fields])
-        
-        SQL = """INSERT INTO %s (%s) VALUES(""" % (self.table, keys)
-        SQL += """ "%s",""" * len(values) % (values)
-        SQL = SQL[:-1] + ")"
-
-        with Connection() as conn:
-            cur = conn.cursor()
-            try:
-                cur.execute(SQL)
-            except sqlite3.IntegrityError:
-                showinfo("SaveError", "This record already exists")
-            except Exception as e:
-                showinfo("SaveError", str(e))
-            else:
-                showinfo("Done", "Saved record with file number: %s"%values[0])
-
-
-    def exists_in_records(self):
+    @measured("Save")
+    def Save(self):
+        # Saves a new file or the changes to one already recorded
         try:
-            REF = self.entries["ORIGINAL_REF_NO"].get()
-            sql = "SELECT * FROM %s WHERE ORIGINAL_REF_NO='%s'"%(self.table, REF)
-
-        except KeyError:
-            REF = self.entries["CURRENT_REF_NO"].get()
-            sql = "SELECT * FROM %s WHERE CURRENT_REF_NO='%s'"%(self.table, REF)
-        
-        with Connection() as conn:
-            cur = conn.cursor()
-            cur.execute(sql)
-            results = cur.fetchone()
-
-            if results:
-                return True
-
+            created, record = db.save_record(self.table,
+                self.form_values(strip=True))
+        except sqlite3.IntegrityError as e:
+            showinfo("SaveError", "Another file has this number (%s)" % e)
+        except Exception as e:
+            showinfo("SaveError", write_error(e))
+        else:
+            # Shows the dates as they were stored
+            self.fill_form([record])
+            if created:
+                showinfo("Done", "Saved new record with file number: %s"
+                    % record[self.queries.key])
             else:
-                return False
+                showinfo("Done", "Updated the existing record with file"
+                    " number: %s" % record[self.queries.key])
 
 
+    @measured("Update")
     def Update(self):
-        if not self.exists_in_records():
-            showinfo("Aborted", "This Ref Number is not in records")
-            return False
-
-        values = []
-        for ent in self.entries.values():
-            try:
-                values.append(ent.get())
-            except TclError:
-                pass
-
-        values = tuple(values)
-        keys = ", ".join([f.upper().replace(" ", "_") for f in self.fields])
-
-        SQL = """UPDATE {} SET """.format(self.table)
-
-        for key, value in zip(keys.split(", "), values):
-            SQL += """ %s = "%s" ,""" % (key, value)
-
-        if "ORIGINAL_REF_NO" in self.entries:
-            SQL = SQL[:-1] + """ WHERE ORIGINAL_REF_NO = "%s" """%values[0]
+        try:
+            record = db.update_record(self.table, self.form_values())
+        except Exception as e:
+            showinfo("Update Error", write_error(e))
         else:
-            SQL = SQL[:-1] + """ WHERE CURRENT_REF_NO = "%s" """%values[0]
-
-        with Connection() as conn:
-            cur = conn.cursor()
-            try:
-                cur.execute(SQL)
-            except Exception as e:
-                showinfo("Update Error", str(e))
-            else:
-                showinfo("Success","Updated the File record: %s"%values[0])
+            if record is None:
+                showinfo("Aborted", "This Ref Number is not in records")
+                return False
+            showinfo("Success","Updated the File record: %s"
+                % record[self.queries.key])
 
 
+    @measured("Find")
     def Find(self, event=None, REF=None):
-        if "ORIGINAL_REF_NO" in self.entries:
-            if REF:
-                SQL = "SELECT * FROM %s WHERE ORIGINAL_REF_NO='%s'"%(
-                    self.table, REF)
-            else:
-                SQL = "SELECT * FROM %s WHERE ORIGINAL_REF_NO='%s'"%(
-                    self.table, self.entries['ORIGINAL_REF_NO'].get())
-        else:
-            if REF:
-                SQL = "SELECT * FROM %s WHERE CURRENT_REF_NO='%s'"%(
-                    self.table, REF)
-            else:
-                SQL = "SELECT * FROM %s WHERE CURRENT_REF_NO='%s'"%(
-                    self.table, self.entries['CURRENT_REF_NO'].get())
+        if not REF:
+            REF = self.entries[self.queries.key].get()
 
-        with Connection() as conn:
-            cur = conn.cursor()
-            try:
-                cur.execute(SQL)
-            except Exception as e:
-                showinfo("Lookup Error", str(e))
-            else:
-                results = cur.fetchall()
-                colnames = [d[0] for d in cur.description]
-                results_dict = [dict(zip(colnames, r)) for r in results]
-
-                if results_dict:
-                    for key, val in results_dict[0].items():
-                        self.entries[key].delete(0, END)
-                        self.entries[key].insert(0, val)
+        try:
+            record = db.find_record(self.table, REF)
+        except Exception as e:
+            showinfo("Lookup Error", str(e))
+        else:
+            if record:
+                self.fill_form([record])
 
 
+    @measured("Delete")
     def Delete(self):
         ref = self.entries[self.fields[0].upper().replace(" ","_")].get()
         if not ref:
@@ -347,25 +898,16 @@ class Base:
         if ans !='yes':
             return False
 
-        if not self.exists_in_records():
-            showinfo("Delete", 'This record does not exist in database')
-            return False
-
-        if "ORIGINAL_REF_NO" in self.entries:
-            SQL = "DELETE FROM %s WHERE ORIGINAL_REF_NO='%s'"%(self.table, 
-                self.entries['ORIGINAL_REF_NO'].get())
+        try:
+            deleted = db.delete_record(self.table,
+                self.entries[self.queries.key].get())
+        except Exception as e:
+            showinfo("Info", write_error(e))
         else:
-            SQL = "DELETE FROM %s WHERE CURRENT_REF_NO='%s'"%(self.table, 
-                self.entries['CURRENT_REF_NO'].get())
-
-        with Connection() as conn:
-            try:
-                cur = conn.cursor()
-                cur.execute(SQL)
-            except Exception as e:
-                showinfo("Info", str(e))
-            else:
-                showinfo("Success", "Delete record successfully")
+            if not deleted:
+                showinfo("Delete", 'This record does not exist in database')
+                return False
+            showinfo("Success", "Delete record successfully")
 
 
     def Clear(self):
@@ -382,23 +924,29 @@ class Base:
 
 
     def FindComplainant(self, complainant=None):
-        if complainant:
-            SQL = "SELECT * FROM {} WHERE COMPLAINANT LIKE '%{}%'".format(
-                self.table, complainant) 
-        else:
-            SQL = "SELECT * FROM {}".format(self.table)
+        if complainant is None:
+            return self.FindAll()
 
-        with Connection() as conn:
-            cur = conn.cursor()
-            try:
-                cur.execute(SQL)
-            except Exception as e:
-                showinfo("Lookup Error", str(e))
+        def work():
+            colnames, results = db.search_files(complainant)
+            colnames = [c.replace("_", " ") for c in colnames]
+            return colnames, results
+
+        def done(found):
+            colnames, results = found
+            if results:
+                self.show_tree(colnames, results)
             else:
-                results = cur.fetchall()
-                colnames = [d[0].replace("_", " ") for d in cur.description]
-                if results:
-                    self.show_tree(colnames, results)
+                showinfo("Search", "No files match: %s" % complainant)
+
+        try:
+            search_query(complainant)
+        except ValueError as e:
+            showinfo("Search", str(e))
+            return
+
+        BackgroundQuery(self.toolbar, work, done, self.busy,
+            action="Search")
 
 
     def show_tree(self, headers, data):
@@ -413,95 +961,150 @@ class Base:
             font='Arial 18 bold', fg='blue')
         label.pack(pady=10)
 
+        bar = Frame(top)
+        bar.pack(fill=X)
+        busy = BusyBar(bar)
+        ttk.Button(bar, text="Export...",
+            command=lambda: self.tree.Export(busy)).pack(side=LEFT, padx=4)
+        busy.pack(side=LEFT, fill=X)
+
         self.tree = Treeview(top, headers, self)
+        self.tree.busy = busy
         self.tree.set_register(data)
         self.tree.pack(expand=1, fill=BOTH)
+        return bar
 
 
+    @measured("All Department Files")
     def FindAll(self):
-        self.FindComplainant(complainant=None)
-  
+        # One page of files at a time. Each page is a short indexed
+        # query, so it is read straight away rather than in the background.
+        try:
+            pager = db.Pager(self.table)
+            pager.first()
+        except Exception as e:
+            showinfo("Query Error", str(e))
+            return
+
+        bar = self.show_tree([c.replace("_", " ") for c in pager.columns],
+            pager.page)
+        tree = self.tree
+        tree.pager = pager
+        count = Label(bar)
+
+        def show():
+            tree.set_register(tree.pager.page)
+            count["text"] = "Files %s - %s of %s" % tree.pager.span()
+
+        @measured("Page")
+        def move(step):
+            try:
+                if step():
+                    show()
+            except Exception as e:
+                showinfo("Query Error", str(e))
+
+        def reorder(event=None):
+            tree.pager = db.Pager(self.table, order.get())
+            move(tree.pager.first)
+
+        count.pack(side=RIGHT, padx=8)
+        for text, step in ((">|", "last"), (">", "next"), ("<", "previous"),
+                ("|<", "first")):
+            ttk.Button(bar, text=text, width=3,
+                command=lambda step=step: move(getattr(tree.pager, step))
+                ).pack(side=RIGHT)
+        order = ttk.Combobox(bar, values=Pager.ORDERS, state="readonly",
+            width=8)
+        order.set(pager.order)
+        order.bind("<<ComboboxSelected>>", reorder)
+        order.pack(side=RIGHT, padx=4)
+        Label(bar, text="Order by").pack(side=RIGHT)
+        show()
+
+
+    def import_csv(self, path, progress=None, report=None):
+        return db.import_csv(self.table, path, progress=progress,
+            report=report)
+
+    def ImportCSV(self):
+        if self.import_busy.job:
+            showinfo("Import", "Another import is still running. Wait for"
+                " it to finish or cancel it first.")
+            return
+        path = filedialog.askopenfilename(title="Import CSV",
+            filetypes=[("CSV files", "*.csv"), ("All files", "*.*")])
+        if not path:
+            return
+
+        # The worker thread updates the counts; the Tk thread reads them
+        status = {"text": "Importing..."}
+        report = fmsdb.ImportReport(path)
+
+        def progress(report):
+            status["text"] = "Imported %s of %s rows (%.0f rows/s)" % (
+                report.imported, report.read, report.rate)
+
+        def done(report):
+            showinfo("Import", report.summary())
+
+        def failed(e):
+            # The chunks committed before it stopped stay imported
+            if isinstance(e, sqlite3.OperationalError) and job.cancelled:
+                reason = "The import was cancelled."
+            else:
+                reason = "The import stopped: %s" % e
+            if report.read:
+                reason += "\n" + report.summary()
+            showinfo("Import", reason)
+
+        job = BackgroundQuery(self.toolbar,
+            lambda: self.import_csv(path, progress, report), done,
+            self.import_busy, "Importing...", lambda: status["text"], "Import",
+            failed)
+
+    @measured("Select")
+    def show_record(self, tree, row):
+        # Fills the form from a row picked in a result list. The row may
+        # be older than the last save, so the record is found again; the
+        # lookup cache answers a row picked twice until the file changes.
+        columns = [h.replace(" ", "_") for h in tree.headers]
+        if "DEPARTMENT" in columns and row[columns.index(
+                "DEPARTMENT")] != TABLES[self.table].title:
+            return
+        try:
+            record = db.find_record(self.table, row[0])
+        except Exception as e:
+            showinfo("Lookup Error", str(e))
+            return
+        if record is not None:
+            self.fill_form([record])
 
     def fill_form(self, results_dict):
         for key, val in results_dict[0].items():
             self.entries[key].delete(0, END)
             self.entries[key].insert(0, val)
 
+    def build(self):
+        self.build_interface(TABLES[self.table].title, self.frame)
+
 
 class FilesSentToDPP(Base):
     table = 'files_sent_to_dpp'
     
     def __init__(self, frame):
         self.entries = {}
-        self.fields = [
-        "Original REF NO", "Current REF NO",
-        "Complainant", "Suspect", "Offence",
-        "Investigating Officer",
-        "Date Sent", 
-        "Date Returned",
-        "File Sent To", 
-        "Remarks"]
+        self.fields = TABLES[self.table].fields
         self.frame = frame
 
-        self.create_table()
-
-    def create_table(self):
-        conn = sqlite3.connect("fms.db")
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS files_sent_to_dpp
-            (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
-            CURRENT_REF_NO VARCHAR(15) UNIQUE,
-            COMPLAINANT VARCHAR(30), 
-            SUSPECT VARCHAR(30), 
-            OFFENCE VARCHAR(50),
-            INVESTIGATING_OFFICER VARCHAR(30), 
-            DATE_SENT DATE, 
-            DATE_RETURNED DATE(15),
-            FILE_SENT_TO VARCHAR(20),
-            REMARKS VARCHAR(200))
-            ''')
-    
-
-    def build(self):
-        super().build_interface("Files Sent to DPP/RSA", self.frame)
-
 
 class CourtGoingFiles(Base):
     table = "court_going"
 
     def __init__(self, frame):
         self.entries = {}
-        self.fields = [
-                    "Current REF NO",
-                    "Complainant", "Suspect", "Offence",
-                    "Investigating Officer",
-                    "Date Sent to Court", 
-                    "Date Next in Court", 
-                    "Status Of Case"
-                    ]
-
+        self.fields = TABLES[self.table].fields
         self.frame = frame
-        self.create_table()
-
-    def create_table(self):
-        conn = sqlite3.connect("fms.db")
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS court_going
-            ( 
-            CURRENT_REF_NO VARCHAR(15) PRIMARY KEY,
-            COMPLAINANT VARCHAR(30), 
-            SUSPECT VARCHAR(30), 
-            OFFENCE VARCHAR(50),
-            INVESTIGATING_OFFICER VARCHAR(30), 
-            DATE_SENT_TO_COURT DATE, 
-            DATE_NEXT_IN_COURT DATE, 
-            STATUS_OF_CASE VARCHAR(30))
-            ''')
-
-    def build(self):
-        super().build_interface("Court Going Files", self.frame)
     
 
 class PutAwayFiles(Base):
@@ -509,33 +1112,8 @@ class PutAwayFiles(Base):
 
     def __init__(self, frame):
         self.entries = {}
-        self.fields = [
-        "Original REF NO", "Current REF NO",
-        "Complainant", "Suspect", "Offence",
-        "Location of File", "Status", "Date Sent"]
-
+        self.fields = TABLES[self.table].fields
         self.frame = frame
-        self.create_table()
-
-
-    def create_table(self):
-        conn = sqlite3.connect("fms.db")
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS putaway
-            (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
-            CURRENT_REF_NO VARCHAR(15) UNIQUE,
-            COMPLAINANT VARCHAR(30), 
-            SUSPECT VARCHAR(30), 
-            OFFENCE VARCHAR(50),
-            LOCATION_OF_FILE VARCHAR(30), 
-            STATUS VARCHAR(30), 
-            DATE_SENT DATE)
-            ''')
-    
-
-    def build(self):
-        super().build_interface("Put Away Files", self.frame)
 
 
 class AllocationToInvestigators(Base):
@@ -543,30 +1121,8 @@ class AllocationToInvestigators(Base):
     
     def __init__(self, frame):
         self.entries = {}
-        self.fields = [
-        "Original REF NO", "Current REF NO",
-        "Complainant", "Suspect", "Offence",
-        "Investigating Officer", "Date of Allocation"]
-
+        self.fields = TABLES[self.table].fields
         self.frame = frame
-        self.create_table()
-
-    def create_table(self):
-        conn = sqlite3.connect("fms.db")
-        cur = conn.cursor()
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS allocation
-            (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
-            CURRENT_REF_NO VARCHAR(15) UNIQUE,
-            COMPLAINANT VARCHAR(30), 
-            SUSPECT VARCHAR(30), 
-            OFFENCE VARCHAR(50),
-            INVESTIGATING_OFFICER VARCHAR(30), 
-            DATE_OF_ALLOCATION DATE)
-            ''')
-        
-    def build(self):
-        super().build_interface("Allocation To Investigators", self.frame)
 
 
 # Main gui framework
@@ -584,6 +1140,7 @@ class Main:
             text='FILE MANAGEMENT SYSTEM (CID)',
             font='Arial 18 bold roman', fg='green')
         static.pack(fill=X, pady=10)
+        StatusBar(self.parent, static)
 
         self.container = Frame(parent)
         self.container.pack(side=RIGHT, expand=1)
@@ -606,25 +1163,41 @@ class Main:
             command = self.ShowCourtFiles)
         filemenu.add_command(label="Put Away files",
             command = self.ShowPutAwayFiles)
+        filemenu.add_command(label="Import CSV into these files",
+            command = self.ImportCSV)
         filemenu.add_command(label="Exit",
             command = self.Close)
 
         searchmenu = Menu(menubar, tearoff=0)
-        searchmenu.add_command(label="Search by Complainant",
+        searchmenu.add_command(label="Search by Name or Offence",
             command=self.AdvancedSearch)
         searchmenu.add_command(label="All Department Files",
             command=self.AllDepartmentFiles)
+        searchmenu.add_command(label="Where is this File?",
+            command=self.FileHistory)
 
         analysisMenu = Menu(menubar, tearoff=0)
         analysisMenu.add_command(
             label="Analyse by Date/Month/Year",
             command=self.AnalysisWindow)
+        analysisMenu.add_command(label="Dashboard",
+            command=self.Dashboard)
+        analysisMenu.add_command(label="Rebuild Statistics",
+            command=self.RebuildStatistics)
 
         aboutmenu = Menu(menubar, tearoff=0)
         aboutmenu.add_command(label='Help', 
             command=self.HelpDialog)
         aboutmenu.add_command(label='Developer', 
             command=self.DeveloperDialog)
+        aboutmenu.add_command(label='Database Connections',
+            command=self.ConnectionStats)
+        aboutmenu.add_command(label='Save Query Timings...',
+            command=self.SaveQueryTimings)
+        self.show_status = BooleanVar(value=performance.visible)
+        aboutmenu.add_checkbutton(label='Status Bar',
+            variable=self.show_status,
+            command=lambda: performance.show_bars(self.show_status.get()))
 
         menubar.add_cascade(label="Switch Files", menu=filemenu)
         menubar.add_cascade(label="Advanced Search", menu=searchmenu)
@@ -638,6 +1211,35 @@ class Main:
         win.geometry('1100x600')
 
 
+    @measured("Dashboard")
+    def Dashboard(self):
+        today = date.today()
+        try:
+            rows = db.dashboard(today)
+        except Exception as e:
+            showinfo("Dashboard", str(e))
+            return
+
+        dialog = Dialog("FMS Dashboard")
+        dialog.geometry("700x260")
+
+        Label(dialog, text="Files as at %s" % today.strftime('%d-%m-%Y'),
+            font='Arial 14 bold', fg='blue').pack(pady=6)
+        tree = Treeview(dialog, ["DEPARTMENT", "THIS MONTH", "THIS YEAR",
+            "ALL FILES"], None)
+        tree.pack(expand=1, fill=BOTH)
+        tree.set_register(rows)
+        ttk.Button(dialog, text="Export...", command=tree.Export).pack(pady=4)
+
+    @measured("Rebuild Statistics")
+    def RebuildStatistics(self):
+        try:
+            db.rebuild_counts()
+        except Exception as e:
+            showinfo("Statistics", str(e))
+            return
+        showinfo("Statistics", "File counts have been recalculated")
+
     def HelpDialog(self):
         dialog = Dialog("FMS Help")
         dialog.geometry("600x650")
@@ -684,9 +1286,15 @@ records for that unique number.
 To view all file details for a selected department,
 click 'AdvancedSearch' menu item and choose `AllDepartmentFiles`.
 Click on an entry to view details in the form.
-To Search by Complainant, choose 'Find By Complainant' from the
-the same menu item. Enter the name or part of the name of the complainant
-and hit enter/OK.
+To Search, choose 'Search by Name or Offence' from the same
+menu item. Enter the start of any words of the complainant, suspect,
+offence or investigating officer and hit enter/OK. Matches from all
+four departments are listed, best matches first.
+To see where a file is now and every department it has been
+through, choose 'Where is this File?' and enter its original or
+current REF NO.
+About > Status Bar shows how long the last action spent in the
+database and drawing the list, the rows it read and the memory in use.
         """
 
         text = Label(dialog, text=helptext, justify='left',
@@ -707,11 +1315,45 @@ and hit enter/OK.
         dev = Label(dialog, text=text, font='Calibri 12', justify='left')
         dev.pack(anchor='w')
 
+    def ConnectionStats(self):
+        try:
+            stats = db.stats()
+        except Exception as e:
+            showinfo("Database Connections", str(e))
+            return
+        showinfo("Database Connections",
+            "Database: %(database)s\nConnections opened: %(opened)s\n"
+            "Connections reused: %(reused)s\nOpen now: %(open)s\n"
+            "Statement cache hits: %(statement_hits)s\n"
+            "Statement cache misses: %(statement_misses)s\n"
+            "Lookup cache: %(lookup_entries)s of %(lookup_size)s entries\n"
+            "Lookup hits: %(lookup_hits)s, misses: %(lookup_misses)s\n"
+            "Lookup invalidations: %(lookup_invalidations)s\n"
+            "Writes: %(writes)s in %(write_commits)s commits, "
+            "%(write_retries)s retried while busy\n"
+            "Slow statements: %(slow)s (over %(slow_query_ms)s ms, "
+            "logged to %(slow_query_log)s)" % stats)
+
+    def SaveQueryTimings(self):
+        # Latency histograms of every operation and statement so far
+        path = filedialog.asksaveasfilename(title="Save Query Timings",
+            defaultextension=".json", filetypes=[("JSON files", "*.json")])
+        if not path:
+            return
+        try:
+            timings = db.timings()
+            with open(path, "w", encoding="utf-8") as out:
+                json.dump(timings, out, indent=2)
+        except Exception as e:
+            showinfo("Save Query Timings", str(e))
 
     def Close(self, event=None):
         # answer = askquestion("Quit", 
         #     "Are you sure you want to close the program?")
         # if answer=='yes':
+        manager.interrupt()
+        query_pool.shutdown(cancel_futures=True)
+        manager.close()
         self.parent.destroy()
 
     def ShowDPPFiles(self):
@@ -754,12 +1396,36 @@ and hit enter/OK.
         self.parent.update() 
 
 
+    def ImportCSV(self):
+        self.window.ImportCSV()
+
     def AdvancedSearch(self):
-        AskString(self.window, self.parent,"Name", "Enter name of complainant")
+        AskString(self.window, self.parent, "Search",
+            "Complainant, suspect, offence or officer")
         
     def AllDepartmentFiles(self):
         self.window.FindAll()
 
+    @measured("Where is this File?")
+    def FileHistory(self):
+        ref = askstring("Where is this File?", "Original or current REF NO",
+            parent=self.parent)
+        if not ref or not ref.strip():
+            return
+
+        colnames, rows = db.file_history(ref.strip())
+        if not rows:
+            showinfo("Where is this File?", "No file with REF NO: %s" % ref)
+            return
+
+        dialog = Dialog("FMS: File History")
+        dialog.geometry("900x300")
+        Label(dialog, text="%s is now with: %s" % (rows[-1][0], rows[-1][2]),
+            font='Arial 14 bold', fg='blue').pack(pady=6)
+        tree = Treeview(dialog, [c.replace("_", " ") for c in colnames], None)
+        tree.pack(expand=1, fill=BOTH)
+        tree.set_register(rows)
+
 
 class SQLWindow(Dialog):
     def __init__(self, title):
@@ -777,6 +1443,7 @@ class SQLWindow(Dialog):
 
         toolbar = LabelFrame(self, text='  Specify A range of dates OR a month and year or a year  ', padx=5, pady=5)
         toolbar.pack(expand=0, fill=X)
+        StatusBar(self, toolbar)
 
         toolbar0 = Frame(self)
         toolbar0.pack(side=TOP, anchor='w', fill=X)
@@ -790,6 +1457,9 @@ class SQLWindow(Dialog):
         toolbar3 = Frame(toolbar,  relief='raised', bd=2)
         toolbar3.pack(side=LEFT, fill=BOTH, padx=4, anchor='s')
 
+        toolbar4 = Frame(toolbar,  relief='raised', bd=2)
+        toolbar4.pack(side=LEFT, fill=BOTH, padx=4, anchor='s')
+
         self.main = Frame(self)
         self.main.pack(expand=1, fill=BOTH)
 
@@ -806,6 +1476,10 @@ class SQLWindow(Dialog):
         self.choice_entry.configure(foreground='navyblue')
         self.choice_entry.grid(row=1, column=1, sticky='w')
         self.choice_entry.configure(font='Calibri 12 bold')
+
+        export = ttk.Button(toolbar0, text='EXPORT RESULTS',
+            command=lambda: self.tree.Export(self.busy))
+        export.grid(row=1, column=2, sticky='w', padx=10)
         
         # Left side
         fromlabel = Label(toolbar1, text="FROM DATE")
@@ -831,6 +1505,9 @@ class SQLWindow(Dialog):
         self.totalFile = Label(self, text="", fg='blue', font='Arial 12 bold')
         self.totalFile.pack(anchor=W)
 
+        self.busy = BusyBar(self)
+        self.busy.pack(anchor=W, fill=X)
+
 
         # Middle side
         Label(toolbar2, text="MONTH (e.g 01)", 
@@ -861,9 +1538,25 @@ class SQLWindow(Dialog):
         submit3 = ttk.Button(toolbar3, text='SUBMIT', command=self.ReQueryYear)
         submit3.grid(row=4, column=0, columnspan=2, pady=2)
 
+        # Summary counts
+        Label(toolbar4, text="GROUP BY", font='Calibri 12 bold'
+            ).grid(row=1, column=0)
+
+        self.group_entry = ttk.Combobox(toolbar4, width=14,
+            values=list(GROUPS), state='readonly')
+        self.group_entry.configure(font='Calibri 12')
+        self.group_entry.grid(row=1, column=1, pady=4, padx=4, sticky='w')
+        self.group_entry.set("MONTH")
+        submit4 = ttk.Button(toolbar4, text='SUMMARY', command=self.Summarise)
+        submit4.grid(row=4, column=0, columnspan=2, pady=2)
+
         # Bottom Tree
         self.tree = Treeview(self.main, [], self)
+        self.tree.busy = self.busy
         self.tree.pack(expand=1, fill=BOTH, pady=10)
+        self.tree.bind("<Double-1>", self.DrillDown)
+        self.summary = None
+        self.period = None
 
         # Set Defaults
         now = datetime.now().date()
@@ -877,203 +1570,162 @@ class SQLWindow(Dialog):
         self.from_entry.insert(0, _from)
         self.to_entry.insert(0, _to)
 
+    def getPeriodByDate(self):
+        _from = parse_date(self.from_entry.get())
+        _to = parse_date(self.to_entry.get())
+        return _from, _to + timedelta(days=1)
+
+    def getPeriodByMonth(self):
+        try:
+            return month_bounds(self.month.get(), self.year.get())
+        except ValueError:
+            raise ValueError("Enter a month (01-12) and a year (e.g 2017)")
+
+    def getPeriodByYear(self):
+        try:
+            return year_bounds(self.fullyear.get())
+        except ValueError:
+            raise ValueError("Enter a year (e.g 2017)")
+
+    def periodQuery(self, getPeriod):
+        # The arguments of db.period_files(), checked before they are sent
+        dept = self.choice_entry.get()
+        start, end = getPeriod()
+        date_range_query(dept, start, end)
+        return dept, start, end
+
     def getQueryByDate(self):
-        dept  = self.choice_entry.get()
-        _from = self.from_entry.get().replace("/", '-')
-        _to = self.to_entry.get().replace("/", '-')
-
-        if dept == 'FILES SENT TO DPP':
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%d-%m-%Y', DATE_SENT) >= '{}'
-            AND strftime('%d-%m-%Y', DATE_SENT) <= '{}'
-            AND FILE_SENT_TO='DPP'
-            """.format(_from, _to)
-
-        elif dept == "FILES SENT TO RSA":
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%d-%m-%Y', DATE_SENT) >= '{}'
-            AND strftime('%d-%m-%Y', DATE_SENT) <= '{}'
-            AND FILE_SENT_TO='RSA'
-            """.format(_from, _to)
-            
-        elif dept == 'PUT AWAY FILES':
-            SQL = """
-            SELECT * FROM putaway 
-            WHERE strftime('%d-%m-%Y', DATE_SENT) >= '{}'
-            AND strftime('%d-%m-%Y', DATE_SENT) <= '{}' 
-            """
-            SQL = SQL.format(_from, _to)
-
-        elif dept == 'COURT GOING FILES':
-            SQL = """
-            SELECT * FROM court_going 
-            WHERE strftime('%d-%m-%Y', DATE_SENT_TO_COURT) >= '{}'
-            AND strftime('%d-%m-%Y', DATE_SENT_TO_COURT) <= '{}' """
-            SQL = SQL.format(_from, _to)
-
-        elif dept == 'FILES ALLOCATED TO INVESTIGATORS':
-            SQL = """
-            SELECT * FROM allocation 
-            WHERE strftime('%d-%m-%Y', DATE_OF_ALLOCATION) >= '{}'
-            AND strftime('%d-%m-%Y', DATE_OF_ALLOCATION) <= '{}' """
-            SQL = SQL.format(_from, _to)
-
-        return SQL
+        return self.periodQuery(self.getPeriodByDate)
 
     def getQueryByMonth(self):
-        dept  = self.choice_entry.get()
-        month = self.month.get()
-        year = self.year.get()
-
-        if dept == 'FILES SENT TO DPP':
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%m-%Y', DATE_SENT) == '{}-{}'
-            AND FILE_SENT_TO='DPP'
-            """.format(month, year)
-
-        elif dept == "FILES SENT TO RSA":
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%m-%Y', DATE_SENT) == '{}-{}'
-            AND FILE_SENT_TO='RSA'
-            """.format(month, year)
-            
-        elif dept == 'PUT AWAY FILES':
-            SQL = """
-            SELECT * FROM putaway 
-            WHERE strftime('%m-%Y', DATE_SENT) == '{}-{}' 
-            """
-            SQL = SQL.format(month, year)
-
-        elif dept == 'COURT GOING FILES':
-            SQL = """
-            SELECT * FROM court_going 
-            WHERE strftime('%m-%Y', DATE_SENT_TO_COURT) == '{}-{}' """
-            SQL = SQL.format(month, year)
-
-        elif dept == 'FILES ALLOCATED TO INVESTIGATORS':
-            SQL = """
-            SELECT * FROM allocation 
-            WHERE strftime('%m-%Y', DATE_OF_ALLOCATION) == '{}-{}' """
-            SQL = SQL.format(month, year)
-
-        return SQL
+        return self.periodQuery(self.getPeriodByMonth)
 
     def getQueryByYear(self):
-        dept  = self.choice_entry.get()
-        year = self.fullyear.get()
-
-        if dept == 'FILES SENT TO DPP':
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%Y', DATE_SENT) == '{}'
-            AND FILE_SENT_TO='DPP'
-            """.format(year)
-
-        elif dept == "FILES SENT TO RSA":
-            SQL = """
-            SELECT * FROM files_sent_to_dpp 
-            WHERE strftime('%Y', DATE_SENT) == '{}'
-            AND FILE_SENT_TO='RSA'
-            """.format(year)
-            
-        elif dept == 'PUT AWAY FILES':
-            SQL = """
-            SELECT * FROM putaway 
-            WHERE strftime('%Y', DATE_SENT) == '{}' 
-            """
-            SQL = SQL.format(year)
-
-        elif dept == 'COURT GOING FILES':
-            SQL = """
-            SELECT * FROM court_going 
-            WHERE strftime('%Y', DATE_SENT_TO_COURT) == '{}' """
-            SQL = SQL.format(year)
-
-        elif dept == 'FILES ALLOCATED TO INVESTIGATORS':
-            SQL = """
-            SELECT * FROM allocation 
-            WHERE strftime('%Y', DATE_OF_ALLOCATION) == '{}' """
-            SQL = SQL.format(year)
-
-        return SQL
+        return self.periodQuery(self.getPeriodByYear)
 
-    def ReQueryMonth(self):
-        sql = self.getQueryByMonth()
-        with Connection() as conn:
-            cur= conn.cursor()
-            cur.execute(sql)
-            results = cur.fetchall()
-            colnames = [d[0].replace("_", " ") for d in cur.description]
+    def runQuery(self, getQuery, description, files=None):
+        # getQuery gives the arguments of files, by default the files of
+        # a department over a period
+        files = files or db.period_files
+        try:
+            args = getQuery()
+        except ValueError as e:
+            showinfo("Analysis", str(e))
+            return
+
+        self.summary = None
+
+        def work():
+            return files(*args)
+
+        def done(result):
+            total, columns, results = result
+            colnames = [c.replace("_", " ") for c in columns]
             self.handleResult(results, colnames)
+            self.totalFile['text'] = "TOTAL: %s %s" % (total, description)
 
-            if results:
-                self.totalFile['text'] = "TOTAL: %s %s IN THE MONTH-YEAR(%s-%s)"%(len(results), 
-                    self.choice_entry.get(), self.month.get(), self.year.get())
-            else: 
-                self.totalFile['text'] = "TOTAL: 0 %s IN THE MONTH-YEAR(%s-%s)"%( 
-                    self.choice_entry.get(), self.month.get(), self.year.get())
+        BackgroundQuery(self, work, done, self.busy, "Querying...",
+            action="Analysis")
 
+    def ReQueryMonth(self):
+        self.period = self.getPeriodByMonth, "IN THE MONTH-YEAR(%s-%s)" % (
+            self.month.get(), self.year.get())
+        self.runQuery(self.getQueryByMonth, "%s IN THE MONTH-YEAR(%s-%s)" % (
+            self.choice_entry.get(), self.month.get(), self.year.get()))
 
     def ReQueryYear(self):
-        sql = self.getQueryByYear()
-        with Connection() as conn:
-            cur= conn.cursor()
-            cur.execute(sql)
-            results = cur.fetchall()
-            
-            if results:
-                self.totalFile['text'] = "TOTAL: %s %s"%(
-                    len(results), 
-                    self.choice_entry.get() + " IN THE YEAR %s"%self.fullyear.get()) 
-            else: 
-                self.totalFile['text'] = "TOTAL: 0 %s"%( 
-                self.choice_entry.get() + " IN THE YEAR %s"%self.fullyear.get())  
-
-            colnames = [d[0].replace("_", " ") for d in cur.description]
-            self.handleResult(results, colnames)
+        self.period = self.getPeriodByYear, "IN THE YEAR %s" % self.fullyear.get()
+        self.runQuery(self.getQueryByYear, "%s IN THE YEAR %s" % (
+            self.choice_entry.get(), self.fullyear.get()))
 
     def ReQueryRange(self):
-        sql = self.getQueryByDate()
-        with Connection() as conn:
-            cur= conn.cursor()
-            cur.execute(sql)
-            results = cur.fetchall()
-            colnames = [d[0].replace("_", " ") for d in cur.description]
-            self.handleResult(results, colnames)
+        self.period = self.getPeriodByDate, "FROM %s TO %s" % (
+            self.from_entry.get(), self.to_entry.get())
+        self.runQuery(self.getQueryByDate, "%s FROM %s TO %s" % (
+            self.choice_entry.get(), self.from_entry.get(), self.to_entry.get()))
+
+    def Summarise(self):
+        # Counts per group over the period of the last query
+        dept, group = self.choice_entry.get(), self.group_entry.get()
+        getPeriod, period = self.period or (self.getPeriodByDate,
+            "FROM %s TO %s" % (self.from_entry.get(), self.to_entry.get()))
+        try:
+            start, end = getPeriod()
+            summary_query(dept, group, start, end)
+        except ValueError as e:
+            showinfo("Analysis", str(e))
+            return
+
+        def work():
+            return db.summarise(dept, group, start, end)
+
+        def done(result):
+            colnames, rows = result
+            self.summary = dept, group, start, end
+            self.handleResult(rows, colnames)
+            if group == "DEPARTMENT":
+                what = "FILES"
+            else:
+                what = dept
+            self.totalFile['text'] = "TOTAL: %s %s %s BY %s " \
+                "(double-click a row to list its files)" % (
+                sum(r[-1] for r in rows), what, period, group)
+
+        BackgroundQuery(self, work, done, self.busy, "Counting...",
+            action="Summary")
+
+    def DrillDown(self, event=None):
+        if not self.summary:
+            return
+        selected = self.tree.selection()
+        if not selected or selected[0] not in self.tree.shown:
+            return
+
+        dept, group, start, end = self.summary
+        value = self.tree.shown[selected[0]][0]
+        description = "%s WITH %s %s" % (
+            value if group == "DEPARTMENT" else dept, group, value)
+        self.runQuery(lambda: (dept, group, value, start, end), description,
+            db.group_files)
 
-            if results:
-                self.totalFile['text'] = "TOTAL: %s %s"%(
-                    len(results), 
-                    self.choice_entry.get() + " FROM %s TO %s"%(
-                        self.from_entry.get(), self.to_entry.get()) )
-            else: 
-                self.totalFile['text'] = "TOTAL: 0 %s"%( 
-                    self.choice_entry.get() + " FROM %s TO %s"%(
-                        self.from_entry.get(), self.to_entry.get()) )  
-    
     def handleResult(self, results, colnames):
-        if results:
-            register = results
-        else:
-            register = []
-            colnames=[]
+        # One tree for the life of the window; consecutive queries only
+        # swap the rows that differ
+        self.tree.set_headers(colnames)
+        self.tree.set_register(results)
+
+def show_conflicts(conflicts):
+    # Department rows the migration left in the *_legacy tables
+    dialog = Dialog("FMS: Files to Check")
+    Label(dialog, text=fmsdb.MIGRATION_CONFLICTS, wraplength=600,
+        justify=LEFT).pack(padx=6, pady=6, anchor=W)
+    text = ScrolledText(dialog, width=80, height=15)
+    text.insert(END, "\n".join(conflicts))
+    text.configure(state=DISABLED)
+    text.pack(expand=1, fill=BOTH, padx=6, pady=6)
 
-        self.main.destroy()
-        self.main = Frame(self)
-        self.tree = Treeview(self.main, colnames, self)
-        self.tree.pack(expand=1, fill=BOTH)
-        self.tree.set_register(register)
-        self.main.pack(expand=1, fill=BOTH)
 
 def main():
+    global db
+    server = os.environ.get("FMS_SERVER")
+    conflicts = []
+    if server:
+        import fmsserver
+        db = fmsserver.Client(server)
+    else:
+        # The schema is brought up to date once; the forms never touch it
+        try:
+            conflicts = migrate()
+        except sqlite3.NotSupportedError as e:
+            Tk().withdraw()
+            showinfo("FMS", str(e))
+            return
     root = Tk()
     
     app = Main(root)
-    root.title("FMS")
+    root.title("FMS" if db is fmsdb else "FMS (server %r)" % db)
+    if conflicts:
+        show_conflicts(conflicts)
     root.mainloop()
 
 if __name__ == '__main__':
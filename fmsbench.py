@@ -0,0 +1,387 @@
+"""Benchmarks for the File Management System.
+
+    python fmsbench.py --rows 10000
+    python fmsbench.py --rows 10000 100000 1000000 -o report.json
+    python fmsbench.py --rows 100000 --baseline report.json
+
+Each size gets its own database of synthetic files, generated from the
+seed so every run measures the same data. The timings go through the
+same fmsdb calls the forms make and are printed as JSON; with
+--baseline each timing also shows how it compares with an earlier report.
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from datetime import date, timedelta
+
+import fmsdb
+
+STATIONS = ("GEF", "KLA", "CPS", "JJA", "MBR", "GUL")
+
+FIRST_NAMES = ("John", "Mary", "Peter", "Grace", "Joseph", "Sarah", "David",
+    "Ruth", "Moses", "Esther", "Paul", "Agnes", "Simon", "Florence", "James",
+    "Harriet", "Robert", "Juliet", "Isaac", "Rose")
+
+SURNAMES = ("Okello", "Namubiru", "Mugisha", "Achieng", "Ssemakula",
+    "Nakato", "Opio", "Atuhaire", "Kato", "Nansubuga", "Byaruhanga",
+    "Akello", "Wasswa", "Babirye", "Tumusiime", "Lubega", "Auma", "Kiggundu",
+    "Nalwoga", "Odongo")
+
+OFFENCES = ("Theft", "Assault", "Robbery", "Burglary", "Fraud",
+    "Obtaining money by false pretence", "Criminal trespass",
+    "Malicious damage", "Defilement", "Murder", "Threatening violence",
+    "Forgery", "Causing death by reckless driving", "Arson")
+
+RANKS = ("D/C", "D/Cpl", "D/Sgt", "D/AIP", "D/IP", "D/ASP")
+
+STATUSES = ("Pending", "Adjourned", "Hearing", "Judgement", "Closed",
+    "Committed for trial")
+
+SHELVES = ["Shelf %s%d" % (row, n) for row in "ABCDEF" for n in range(1, 9)]
+
+# Dates fall between these two days
+FIRST_DAY = date(2010, 1, 1)
+LAST_DAY = date(2017, 12, 31)
+
+# Share of the generated files each department holds
+FILES_PER_ROW = 1.25
+
+
+def name(rand):
+    return "%s %s" % (rand.choice(FIRST_NAMES), rand.choice(SURNAMES))
+
+
+def ref(i, prefix=None):
+    # Unique for every i: the number and year together never repeat
+    years = LAST_DAY.year - FIRST_DAY.year + 1
+    return "%s %d/%d" % (prefix or STATIONS[i % len(STATIONS)],
+        1000 + i // years, FIRST_DAY.year + i % years)
+
+
+def day(rand):
+    return FIRST_DAY + timedelta(days=rand.randrange(
+        (LAST_DAY - FIRST_DAY).days + 1))
+
+
+def file_details(rand, i):
+    return (ref(i), ref(i, "CRB"), name(rand), name(rand),
+        rand.choice(OFFENCES), "%s %s" % (rand.choice(RANKS), name(rand)))
+
+
+def movement(rand, table):
+    # (DATE, NEXT_DATE, PLACE, NOTE) as the department would record them
+    sent = day(rand)
+    later = (sent + timedelta(days=rand.randrange(7, 120))).isoformat()
+    if table == "files_sent_to_dpp":
+        return (sent.isoformat(), later if rand.random() < 0.6 else "",
+            "DPP" if rand.random() < 0.7 else "RSA",
+            rand.choice(("Perused", "Further inquiries", "Sanctioned", "")))
+    if table == "court_going":
+        return (sent.isoformat(), later, None, rand.choice(STATUSES))
+    if table == "putaway":
+        return (sent.isoformat(), None, rand.choice(SHELVES),
+            rand.choice(("Closed", "Put away", "Pending inquiry")))
+    return (sent.isoformat(), None, None, None)
+
+
+def record(table, details, move):
+    # The values of the department's form, in column order
+    queries = fmsdb.TABLES[table].queries
+    fields = {"ORIGINAL_REF_NO": details[0]}
+    fields.update(zip(fmsdb.FILE_COLUMNS, details[1:]))
+    moved = dict(zip(("DATE", "NEXT_DATE", "PLACE", "NOTE"), move))
+    for column, to in fmsdb.TABLES[table].movement.items():
+        fields[column] = moved[to] or ""
+    return tuple(fields[c] or "" for c in queries.columns)
+
+
+def generate(path, rows, seed):
+    # A fresh database with rows files in every department. Rows are
+    # written straight to files and movements; the triggers keep the
+    # search index and file counts as they would be after saving them.
+    if os.path.exists(path):
+        os.remove(path)
+    fmsdb.manager.configure(path)
+    fmsdb.migrate()
+    rand = random.Random(seed)
+    files = int(rows * FILES_PER_ROW)
+
+    with fmsdb.Connection() as conn:
+        conn.executemany("INSERT INTO files (ID, REF, CURRENT_REF_NO,"
+            " COMPLAINANT, SUSPECT, OFFENCE, INVESTIGATING_OFFICER)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((i + 1,) + file_details(rand, i) for i in range(files)))
+        for table in fmsdb.TABLES:
+            held = sorted(rand.sample(range(files), rows))
+            conn.executemany("INSERT INTO movements (FILE_ID, DEPARTMENT,"
+                " DATE, NEXT_DATE, PLACE, NOTE) VALUES (?, ?, ?, ?, ?, ?)",
+                ((i + 1, table) + movement(rand, table) for i in held))
+        conn.execute("ANALYZE")
+    return files
+
+
+def summary(seconds):
+    # Milliseconds
+    seconds = sorted(seconds)
+    count = len(seconds)
+
+    def ms(value):
+        return round(value * 1000, 3)
+
+    return OrderedDict([("count", count), ("total_ms", ms(sum(seconds))),
+        ("mean_ms", ms(sum(seconds) / count)),
+        ("median_ms", ms(seconds[count // 2])),
+        ("p95_ms", ms(seconds[min(count - 1, int(count * 0.95))])),
+        ("min_ms", ms(seconds[0])), ("max_ms", ms(seconds[-1]))])
+
+
+class Timings:
+    def __init__(self):
+        self.samples = OrderedDict()
+
+    def time(self, name, func, *args):
+        started = time.perf_counter()
+        result = func(*args)
+        self.samples.setdefault(name, []).append(
+            time.perf_counter() - started)
+        return result
+
+    def report(self):
+        return OrderedDict((name, summary(seconds))
+            for name, seconds in self.samples.items())
+
+
+def bench_save(timings, rand, files, repeat):
+    # Base.Save: new files, then existing files saved back unchanged.
+    # The new files are deleted again so the data stays as generated.
+    for table in fmsdb.TABLES:
+        created = []
+        for n in range(repeat):
+            i = files + n
+            values = record(table, file_details(rand, i),
+                movement(rand, table))
+            timings.time("Save new " + table, fmsdb.save_record, table, values)
+            created.append(values[0])
+        for key in created:
+            fmsdb.delete_record(table, key)
+
+        for key in refs(table, rand, repeat):
+            values = tuple(fmsdb.find_record(table, key).values())
+            timings.time("Save existing " + table, fmsdb.save_record, table,
+                values)
+
+
+def refs(table, rand, count):
+    # Refs of files the department holds, as its form would key them
+    queries = fmsdb.TABLES[table].queries
+    with fmsdb.Connection() as conn:
+        first, last = conn.execute("SELECT MIN(ID), MAX(ID) FROM movements"
+            " WHERE DEPARTMENT = ?", (table,)).fetchone()
+        keys = []
+        while len(keys) < count:
+            row = conn.execute("SELECT f.%s FROM movements m JOIN files f"
+                " ON f.ID = m.FILE_ID WHERE m.ID >= ? AND m.DEPARTMENT = ?"
+                " ORDER BY m.ID LIMIT 1" % queries.file_key,
+                (rand.randint(first, last), table)).fetchone()
+            if row:
+                keys.append(row[0])
+    return keys
+
+
+def bench_find(timings, rand, repeat):
+    # Base.Find, each ref looked up for the first time
+    for table in fmsdb.TABLES:
+        for key in refs(table, rand, repeat):
+            fmsdb.lookups.clear()
+            timings.time("Find " + table, fmsdb.find_record, table, key)
+
+
+def bench_search(timings, rand, repeat):
+    # Base.FindComplainant with the kinds of words clerks type
+    words = [lambda: rand.choice(SURNAMES),
+        lambda: name(rand),
+        lambda: rand.choice(OFFENCES),
+        lambda: "%s %s" % (rand.choice(SURNAMES), rand.choice(OFFENCES))]
+    for n in range(repeat):
+        fmsdb.lookups.clear()
+        timings.time("FindComplainant", fmsdb.search_files,
+            words[n % len(words)]())
+
+
+def bench_pages(timings, repeat):
+    # Base.FindAll: the first page, paging on, and the last page
+    for table in fmsdb.TABLES:
+        for order in fmsdb.Pager.ORDERS:
+            name = "FindAll %s by %s" % (table, order)
+            for n in range(max(1, repeat // 10)):
+                pager = fmsdb.Pager(table, order)
+                timings.time(name + " first", pager.first)
+                for step in range(10):
+                    timings.time(name + " next", pager.next)
+                timings.time(name + " last", pager.last)
+                timings.time(name + " previous", pager.previous)
+
+
+def bench_analysis(timings, rand, repeat):
+    # SQLWindow.getQueryByDate, getQueryByMonth and getQueryByYear, as
+    # runQuery reads them: the total and the first rows
+    for dept in fmsdb.DEPARTMENTS:
+        for n in range(max(1, repeat // 10)):
+            start = day(rand)
+            periods = [("getQueryByDate", (start, start + timedelta(days=31))),
+                ("getQueryByMonth", fmsdb.month_bounds(start.month,
+                    start.year)),
+                ("getQueryByYear", fmsdb.year_bounds(start.year))]
+            for name, period in periods:
+                total, columns, rows = timings.time("%s %s" % (name, dept),
+                    fmsdb.period_files, dept, *period)
+                rows.close()
+
+
+def bench_tree(timings, rand, repeat):
+    # Treeview.fill_tree and sortby, when there is a display to draw on
+    try:
+        import tkinter
+    except ImportError as e:
+        return "skipped: %s" % e
+    try:
+        root = tkinter.Tk()
+    except tkinter.TclError as e:
+        return "skipped: %s" % e
+    import FMS
+
+    root.withdraw()
+    try:
+        columns, hits = fmsdb.search_files(rand.choice(SURNAMES))
+        pager = fmsdb.Pager("allocation", size=5000)
+        pager.first()
+        registers = [("search", columns, lambda: hits),
+            ("list", pager.columns, lambda: pager.page),
+            ("cursor", pager.columns,
+                lambda: fmsdb.RowSource("SELECT * FROM %s"
+                    % fmsdb.TABLES["allocation"].queries.keyed))]
+        for name, headers, rows in registers:
+            tree = FMS.Treeview(root, headers, None)
+            for n in range(max(1, repeat // 20)):
+                register = rows()
+                timings.time("fill_tree " + name, fill, root, tree, register)
+                timings.time("sortby " + name, sort, root, tree, headers[-1])
+            tree.set_register(None)
+            tree.destroy()
+    finally:
+        root.destroy()
+
+
+def fill(root, tree, register):
+    tree.set_register(register)
+    root.update_idletasks()
+
+
+def sort(root, tree, column):
+    tree.sortby(tree, column, 0)
+    root.update_idletasks()
+
+
+def revision():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True, text=True, timeout=10).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return ""
+
+
+def run(rows, seed, repeat, path):
+    generated = time.perf_counter()
+    files = generate(path, rows, seed)
+    generated = time.perf_counter() - generated
+
+    timings = Timings()
+    rand = random.Random(seed)
+    bench_save(timings, rand, files, repeat)
+    bench_find(timings, rand, repeat)
+    bench_search(timings, rand, repeat)
+    bench_pages(timings, repeat)
+    bench_analysis(timings, rand, repeat)
+    tree = bench_tree(timings, rand, repeat)
+
+    result = OrderedDict([("rows", rows), ("files", files),
+        ("generate_seconds", round(generated, 2)),
+        ("database_bytes", os.path.getsize(path)),
+        ("timings", timings.report())])
+    if tree:
+        result["treeview"] = tree
+    return result
+
+
+def compare(report, baseline):
+    # Median time against the baseline's: below 1 is faster
+    earlier = dict((r["rows"], r["timings"]) for r in baseline["results"])
+    for result in report["results"]:
+        before = earlier.get(result["rows"], {})
+        for name, timing in result["timings"].items():
+            if name in before and before[name]["median_ms"]:
+                timing["baseline_median_ms"] = before[name]["median_ms"]
+                timing["ratio"] = round(timing["median_ms"] /
+                    before[name]["median_ms"], 3)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog="fmsbench",
+        description="Time the File Management System on synthetic files")
+    parser.add_argument("--rows", type=int, nargs="+", default=[10000],
+        help="files per department, one run per size (default 10000)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=200,
+        help="lookups and saves timed per department (default 200)")
+    parser.add_argument("--dir", default=".",
+        help="where the benchmark databases are written")
+    parser.add_argument("--keep", action="store_true",
+        help="keep the generated databases")
+    parser.add_argument("--baseline", metavar="REPORT",
+        help="an earlier report to compare against")
+    parser.add_argument("--output", "-o", metavar="PATH",
+        help="write the report to PATH as well as standard output")
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    report = OrderedDict([("revision", revision()), ("seed", args.seed),
+        ("repeat", args.repeat), ("python", platform.python_version()),
+        ("sqlite", sqlite3.sqlite_version), ("platform", platform.platform()),
+        ("results", [])])
+
+    for rows in args.rows:
+        path = os.path.join(args.dir, "fmsbench-%d-%d.db" % (rows, args.seed))
+        try:
+            report["results"].append(run(rows, args.seed, args.repeat, path))
+        finally:
+            fmsdb.manager.close()
+            if not args.keep:
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(path + suffix):
+                        os.remove(path + suffix)
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            compare(report, json.load(f))
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as out:
+            out.write(text + "\n")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,205 @@
+"""Command line reports for the File Management System.
+
+    python FMS.py report --dept dpp --year 2017 --format csv
+    python FMS.py report --dept court --from 2017-01-01 --to 2017-03-31
+    python FMS.py report --dept putaway --year 2017 --group OFFENCE
+    python FMS.py search "john theft"
+    python FMS.py history "GEF 1002/2016"
+    python FMS.py serve --host 0.0.0.0
+
+Only fmsdb is imported, so reports start quickly enough to run from cron.
+"""
+
+import argparse
+import sqlite3
+import sys
+from datetime import date, timedelta
+
+import fmsdb
+
+# Short names for the analysis choices
+DEPTS = {
+    "dpp": "FILES SENT TO DPP",
+    "rsa": "FILES SENT TO RSA",
+    "putaway": "PUT AWAY FILES",
+    "court": "COURT GOING FILES",
+    "allocation": "FILES ALLOCATED TO INVESTIGATORS",
+}
+
+
+def day(text):
+    try:
+        return fmsdb.parse_date(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def report_period(args):
+    if args.start or args.end:
+        if not (args.start and args.end):
+            raise SystemExit("fms: --from and --to go together")
+        return args.start, args.end + timedelta(days=1)
+    if args.month:
+        return fmsdb.month_bounds(args.month, args.year or date.today().year)
+    if args.year:
+        return fmsdb.year_bounds(args.year)
+    raise SystemExit("fms: give --year, --month or --from/--to")
+
+
+def output(args):
+    if args.output in (None, "-"):
+        return sys.stdout
+    return open(args.output, "w", newline="", encoding="utf-8")
+
+
+def write(args, columns, rows):
+    out = output(args)
+    try:
+        fmsdb.write_stream(out, columns, [rows], args.format == "jsonl")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def report(args):
+    dept = DEPTS[args.dept]
+    start, end = report_period(args)
+    if args.group:
+        columns, rows = fmsdb.summarise(dept, args.group, start, end)
+        write(args, columns, rows)
+        return
+
+    SQL, params = fmsdb.date_range_query(dept, start, end)
+    out = output(args)
+    try:
+        fmsdb.stream_query(SQL, params, out, args.format == "jsonl")
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+
+def search(args):
+    write(args, *fmsdb.search_files(" ".join(args.text), args.limit))
+
+
+def find(args):
+    record = fmsdb.find_record(args.table, args.ref)
+    if record is None:
+        print("fms: %s is not in %s" % (args.ref, args.table), file=sys.stderr)
+        return 1
+    write(args, list(record), [tuple(record.values())])
+
+
+def history(args):
+    columns, rows = fmsdb.file_history(args.ref)
+    if not rows:
+        print("fms: no file with REF NO %s" % args.ref, file=sys.stderr)
+        return 1
+    write(args, columns, rows)
+
+
+def import_file(args):
+    report = fmsdb.import_csv(args.table, args.path)
+    print(report.summary())
+    return 1 if report.rejected else 0
+
+
+def dashboard(args):
+    write(args, ["DEPARTMENT", "THIS_MONTH", "THIS_YEAR", "ALL_FILES"],
+        fmsdb.dashboard(date.today()))
+
+
+def rebuild_stats(args):
+    fmsdb.rebuild_counts()
+
+
+def serve(args):
+    import fmsserver
+    fmsserver.serve(args.host, args.port, args.readers)
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog="fms",
+        description="File Management System reports and maintenance")
+    parser.add_argument("--db", default=fmsdb.DATABASE,
+        help="database file (default %(default)s)")
+    parser.add_argument("--timings", metavar="PATH",
+        help="write the time each query took to PATH as JSON")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    commands.required = True
+
+    def command(name, func, help, rows=True):
+        sub = commands.add_parser(name, help=help)
+        sub.set_defaults(func=func)
+        if rows:
+            sub.add_argument("--format", choices=("csv", "jsonl"),
+                default="csv")
+            sub.add_argument("--output", "-o", metavar="PATH",
+                help="write to PATH instead of standard output")
+        return sub
+
+    sub = command("report", report, "files of a department over a period")
+    sub.add_argument("--dept", required=True, choices=list(DEPTS))
+    sub.add_argument("--year", type=int)
+    sub.add_argument("--month", type=int, choices=range(1, 13),
+        metavar="1-12")
+    sub.add_argument("--from", dest="start", type=day, metavar="DATE")
+    sub.add_argument("--to", dest="end", type=day, metavar="DATE",
+        help="last day of the period, inclusive")
+    sub.add_argument("--group", choices=list(fmsdb.GROUPS),
+        help="count the files per group instead of listing them")
+
+    sub = command("search", search, "search names, offences and officers")
+    sub.add_argument("text", nargs="+")
+    sub.add_argument("--limit", type=int, default=fmsdb.SEARCH_LIMIT)
+
+    sub = command("find", find, "show one file")
+    sub.add_argument("table", choices=list(fmsdb.TABLES))
+    sub.add_argument("ref")
+
+    sub = command("history", history,
+        "where a file is now and the departments it has been through")
+    sub.add_argument("ref", help="original or current REF NO")
+
+    command("dashboard", dashboard, "file counts per department")
+
+    sub = command("import", import_file, "import a CSV into a table", False)
+    sub.add_argument("table", choices=list(fmsdb.TABLES))
+    sub.add_argument("path")
+
+    command("rebuild-stats", rebuild_stats, "recalculate the file counts",
+        False)
+
+    sub = command("serve", serve, "share the database with windows on other"
+        " machines", False)
+    sub.add_argument("--host", default="127.0.0.1",
+        help="address to listen on; 0.0.0.0 for every network")
+    sub.add_argument("--port", type=int, default=8470)
+    sub.add_argument("--readers", type=int, default=4,
+        help="reads answered at the same time")
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    fmsdb.manager.configure(args.db)
+    try:
+        conflicts = fmsdb.migrate()
+        if conflicts:
+            print("fms: %s\n  %s" % (fmsdb.MIGRATION_CONFLICTS,
+                "\n  ".join(conflicts)), file=sys.stderr)
+        return args.func(args) or 0
+    except (ValueError, sqlite3.NotSupportedError) as e:
+        print("fms: %s" % e, file=sys.stderr)
+        return 2
+    except BrokenPipeError:
+        # Output piped into head and the like
+        return 0
+    finally:
+        fmsdb.manager.close()
+        if args.timings:
+            fmsdb.query_stats.dump(args.timings)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
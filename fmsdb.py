@@ -0,0 +1,2117 @@
+"""Data access for the File Management System.
+
+Everything here works without tkinter, so the GUI in FMS.py, the
+command line reports and any scripts share the same queries.
+"""
+import bisect
+import csv
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from datetime import datetime, date
+
+
+DATABASE = "fms.db"
+
+# Settings applied to every connection the manager opens.
+# Negative cache_size is in KiB, mmap_size in bytes, busy_timeout in ms.
+PROFILE = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -16000,
+    "mmap_size": 64 * 1024 * 1024,
+    "busy_timeout": 5000,
+    "cached_statements": 256,
+    # Statements taking at least this long go to the slow query log,
+    # with their query plan. None turns the log off.
+    "slow_query_ms": 200,
+    "slow_query_log": "fms-slow.log",
+    # The log shows only how many values a statement was given and their
+    # types; names and other record details go in only when this is on
+    "slow_query_values": False,
+}
+
+# Connections kept for RowSources after their reads are done, so the
+# next one need not open its own
+READERS_KEPT = 2
+
+# The slow query log is rotated at this size, keeping this many old logs
+SLOW_LOG_BYTES = 1024 * 1024
+SLOW_LOG_BACKUPS = 3
+
+
+class StatementCache:
+    # sqlite3 keeps compiled statements per connection in an LRU keyed
+    # on the SQL text. This mirrors that LRU so reuse can be reported.
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self._seen = {}
+
+    def lookup(self, conn, sql, size):
+        seen = self._seen.setdefault(id(conn), OrderedDict())
+        if sql in seen:
+            seen.move_to_end(sql)
+            self.hits += 1
+        else:
+            seen[sql] = True
+            self.misses += 1
+            if len(seen) > size:
+                seen.popitem(last=False)
+
+    def forget(self, conn):
+        self._seen.pop(id(conn), None)
+
+
+statements = StatementCache()
+
+
+class Histogram:
+    # Latencies counted into buckets, upper bounds in milliseconds
+    BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000,
+        2500, 5000, 10000, float("inf"))
+
+    def __init__(self):
+        self.counts = [0] * len(self.BUCKETS)
+        self.count = 0
+        self.seconds = 0.0
+        self.slowest = 0.0
+        self.rows = 0
+
+    def add(self, seconds, rows=0):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds * 1000)] += 1
+        self.count += 1
+        self.seconds += seconds
+        self.slowest = max(self.slowest, seconds)
+        self.rows += rows
+
+    def percentile(self, fraction):
+        # The upper bound of the bucket holding that share of the calls
+        wanted = fraction * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return min(bound, round(self.slowest * 1000, 3))
+        return 0
+
+    def report(self):
+        return OrderedDict([("count", self.count), ("rows", self.rows),
+            ("total_ms", round(self.seconds * 1000, 3)),
+            ("mean_ms", round(self.seconds * 1000 / max(self.count, 1), 3)),
+            ("p50_ms", self.percentile(0.5)), ("p95_ms", self.percentile(0.95)),
+            ("max_ms", round(self.slowest * 1000, 3)),
+            ("buckets", OrderedDict(("<=%g" % b, c) for b, c in
+                zip(self.BUCKETS, self.counts) if c))])
+
+
+def query_plan(conn, sql, parameters=()):
+    # EXPLAIN QUERY PLAN as indented lines; empty if it cannot be had,
+    # as for requests to a server, which have no connection
+    if conn is None:
+        return []
+    depth = {0: -1}
+    lines = []
+    try:
+        for id, parent, _, detail in sqlite3.Cursor(conn).execute(
+                "EXPLAIN QUERY PLAN " + sql, parameters):
+            depth[id] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[id] + detail)
+    except sqlite3.Error:
+        return []
+    return lines
+
+
+def parameter_types(parameters):
+    # "3 (str, str, NoneType)", for logs that must not hold the values
+    if isinstance(parameters, dict):
+        parameters = list(parameters.values())
+    return "%d (%s)" % (len(parameters),
+        ", ".join(type(p).__name__ for p in parameters))
+
+
+class QueryStats:
+    # Time and rows of every statement by its SQL text, and of each
+    # fmsdb operation by name. Slow statements are logged with their plan.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.statements = {}
+        self.operations = {}
+        self.slow = 0
+        # Running totals for each thread, so a caller can tell what its
+        # own statements cost
+        self.local = threading.local()
+        self.log = logging.getLogger("fms.slow")
+        self.log.propagate = False
+        self.log.setLevel(logging.INFO)
+        self.log_path = None
+
+    def statement(self, conn, sql, parameters, seconds, rows):
+        with self._lock:
+            histogram = self.statements.get(sql)
+            if histogram is None:
+                histogram = self.statements[sql] = Histogram()
+            histogram.add(seconds, rows)
+        local = self.local
+        local.seconds = getattr(local, "seconds", 0.0) + seconds
+        local.rows = getattr(local, "rows", 0) + rows
+
+        threshold = manager.profile.get("slow_query_ms")
+        if threshold is not None and seconds * 1000 >= threshold:
+            self.log_slow(conn, sql, parameters, seconds, rows)
+
+    def thread_totals(self):
+        # (seconds, rows) of every statement this thread has run
+        return (getattr(self.local, "seconds", 0.0),
+            getattr(self.local, "rows", 0))
+
+    def operation(self, name, seconds):
+        with self._lock:
+            histogram = self.operations.get(name)
+            if histogram is None:
+                histogram = self.operations[name] = Histogram()
+            histogram.add(seconds)
+
+    def log_slow(self, conn, sql, parameters, seconds, rows):
+        with self._lock:
+            self.slow += 1
+            path = manager.profile.get("slow_query_log")
+            if path != self.log_path:
+                for handler in self.log.handlers[:]:
+                    self.log.removeHandler(handler)
+                    handler.close()
+                if path:
+                    handler = logging.handlers.RotatingFileHandler(path,
+                        maxBytes=SLOW_LOG_BYTES, backupCount=SLOW_LOG_BACKUPS,
+                        encoding="utf-8", delay=True)
+                    handler.setFormatter(logging.Formatter(
+                        "%(asctime)s %(message)s"))
+                    self.log.addHandler(handler)
+                self.log_path = path
+        if not path:
+            return
+
+        plan = query_plan(conn, sql, parameters)
+        if manager.profile.get("slow_query_values"):
+            shown = repr(parameters)
+        else:
+            shown = parameter_types(parameters)
+        self.log.info("%.1f ms, %s rows, thread %s\n%s\n  parameters: %s%s\n",
+            seconds * 1000, rows, threading.current_thread().name,
+            " ".join(sql.split()), shown,
+            "".join("\n  plan: " + line for line in plan))
+
+    def report(self):
+        # Slowest first by total time
+        def ordered(histograms):
+            return OrderedDict((name, h.report()) for name, h in sorted(
+                histograms.items(), key=lambda item: -item[1].seconds))
+
+        with self._lock:
+            return OrderedDict([("slow_statements", self.slow),
+                ("operations", ordered(self.operations)),
+                ("statements", ordered(dict((" ".join(sql.split()), h)
+                    for sql, h in self.statements.items())))])
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as out:
+            json.dump(self.report(), out, indent=2)
+            out.write("\n")
+
+    def reset(self):
+        with self._lock:
+            self.statements = {}
+            self.operations = {}
+            self.slow = 0
+
+
+query_stats = QueryStats()
+
+
+def timed(func):
+    # Counts the call in the latency histogram named after func
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            query_stats.operation(func.__qualname__,
+                time.perf_counter() - started)
+    return wrapper
+
+
+class Cursor(sqlite3.Cursor):
+    # Times each statement from execute() until its last row is fetched,
+    # counting only the time spent inside the cursor
+    statement = None
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        self.connection.statement_used(sql)
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.statement = [sql, parameters, time.perf_counter() - started, 0]
+            if self.description is None:
+                self.statement[3] = max(self.rowcount, 0)
+                self.finish()
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        self.connection.statement_used(sql)
+        if isinstance(seq_of_parameters, (list, tuple)):
+            first = seq_of_parameters[0] if seq_of_parameters else ()
+        else:
+            first = ()
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.statement = [sql, first, time.perf_counter() - started,
+                max(self.rowcount, 0)]
+            self.finish()
+
+    def fetched(self, started, rows, done):
+        if self.statement:
+            self.statement[2] += time.perf_counter() - started
+            self.statement[3] += rows
+            if done:
+                self.finish()
+
+    def finish(self):
+        statement, self.statement = self.statement, None
+        if statement:
+            query_stats.statement(self.connection, *statement)
+
+    def fetchone(self):
+        started = time.perf_counter()
+        row = super().fetchone()
+        self.fetched(started, 0 if row is None else 1, row is None)
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            size = self.arraysize
+        started = time.perf_counter()
+        rows = super().fetchmany(size)
+        self.fetched(started, len(rows), len(rows) < size)
+        return rows
+
+    def fetchall(self):
+        started = time.perf_counter()
+        rows = super().fetchall()
+        self.fetched(started, len(rows), True)
+        return rows
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = super().__next__()
+        except StopIteration:
+            self.fetched(started, 0, True)
+            raise
+        self.fetched(started, 1, False)
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            pass
+
+
+class SQLiteConnection(sqlite3.Connection):
+    cached_statements = 128
+
+    def cursor(self, factory=Cursor):
+        return super().cursor(factory)
+
+    # The built-in shortcuts would use a plain sqlite3 cursor
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def statement_used(self, sql):
+        statements.lookup(self, sql, self.cached_statements)
+
+
+class ConnectionManager:
+    """Hands out one long-lived, tuned connection per thread."""
+
+    def __init__(self, database=DATABASE, **profile):
+        self.database = database
+        self.profile = dict(PROFILE, **profile)
+        self.opened = 0
+        self.reused = 0
+        self.local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = []
+        self._readers = []
+
+    def configure(self, database=None, **profile):
+        # Takes effect for connections opened after the call
+        self.close()
+        if database:
+            self.database = database
+        self.profile.update(profile)
+
+    def connect(self):
+        conn = sqlite3.connect(self.database,
+            timeout=self.profile["busy_timeout"] / 1000,
+            check_same_thread=False,
+            factory=SQLiteConnection,
+            cached_statements=self.profile["cached_statements"])
+        conn.cached_statements = self.profile["cached_statements"]
+
+        cur = conn.cursor()
+        for pragma in ("busy_timeout", "journal_mode", "synchronous",
+                "cache_size", "mmap_size"):
+            cur.execute("PRAGMA %s = %s" % (pragma, self.profile[pragma]))
+        cur.close()
+
+        with self._lock:
+            self.opened += 1
+            self._connections.append(conn)
+        return conn
+
+    def get(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            self.local.depth = 0
+        else:
+            with self._lock:
+                self.reused += 1
+        return conn
+
+    def reader(self):
+        # A connection of its own for a long read, reusing a kept one
+        with self._lock:
+            if self._readers:
+                return self._readers.pop()
+        return self.connect()
+
+    def put_back(self, conn):
+        # Keeps a reader's connection for the next, up to READERS_KEPT
+        with self._lock:
+            if conn in self._connections and \
+                    len(self._readers) < READERS_KEPT:
+                self._readers.append(conn)
+                return
+        self.release(conn)
+
+    def release(self, conn):
+        # Closes a connection handed out by connect()
+        with self._lock:
+            if conn in self._connections:
+                self._connections.remove(conn)
+        statements.forget(conn)
+        conn.close()
+
+    def interrupt(self):
+        # Aborts whatever statement each open connection is running
+        with self._lock:
+            for conn in self._connections:
+                conn.interrupt()
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, []
+            self._readers = []
+        for conn in connections:
+            statements.forget(conn)
+            conn.close()
+        # Other threads notice the closed connection on their next get()
+        self.local = threading.local()
+
+    def stats(self):
+        return {"database": self.database, "opened": self.opened,
+            "reused": self.reused, "open": len(self._connections),
+            "statement_hits": statements.hits,
+            "statement_misses": statements.misses}
+
+
+manager = ConnectionManager()
+
+
+class Connection:
+    # Borrows the thread's shared connection. Only the outermost block
+    # commits or rolls back; the connection stays open for the next caller.
+    def __init__(self):
+        self.conn = manager.get()
+        self.local = manager.local
+
+    def __enter__(self):
+        self.local.depth += 1
+        return self.conn
+
+    def __exit__(self, exec_type, exec_val, tb):
+        self.local.depth -= 1
+        if self.local.depth:
+            return
+
+        if exec_type:
+            self.conn.rollback()
+        elif self.conn.in_transaction:
+            started = time.perf_counter()
+            self.conn.commit()
+            query_stats.statement(self.conn, "COMMIT", (),
+                time.perf_counter() - started, 0)
+
+
+def column_name(field):
+    return field.upper().replace(" ", "_")
+
+
+# Accepted ways of typing a date; everything is stored as ISO-8601 so
+# range filters compare correctly and can use the date indexes.
+DATE_FORMATS = ("%Y-%m-%d", "%d-%m-%Y", "%d/%m/%Y", "%d.%m.%Y",
+    "%Y/%m/%d", "%d-%m-%y", "%d/%m/%y", "%d %b %Y", "%d %B %Y")
+
+ISO_DATE_GLOB = "[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]"
+
+
+def parse_date(text):
+    text = text.strip()
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            pass
+    raise ValueError("Unrecognised date: %r (use dd-mm-yyyy)" % text)
+
+
+def iso_date(value):
+    # Free text that is not a recognisable date is kept as typed
+    if not value or not value.strip():
+        return value
+    try:
+        return parse_date(value).isoformat()
+    except ValueError:
+        return value
+
+
+def migrate_dates(conn, table):
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)
+        if row[1].startswith("DATE_")]
+    if not columns:
+        return 0
+
+    SQL = "SELECT rowid, %s FROM %s WHERE %s" % (", ".join(columns), table,
+        " OR ".join("%s NOT GLOB '%s'" % (c, ISO_DATE_GLOB) for c in columns))
+    updates = []
+    for row in conn.execute(SQL).fetchall():
+        dates = tuple(iso_date(v) if isinstance(v, str) else v for v in row[1:])
+        if dates != row[1:]:
+            updates.append(dates + (row[0],))
+
+    conn.executemany("UPDATE %s SET %s WHERE rowid = ?" % (table,
+        ", ".join("%s = ?" % c for c in columns)), updates)
+    return len(updates)
+
+
+# Analysis choices: (table, date column, FILE_SENT_TO value)
+DEPARTMENTS = {
+    "FILES SENT TO DPP": ("files_sent_to_dpp", "DATE_SENT", "DPP"),
+    "FILES SENT TO RSA": ("files_sent_to_dpp", "DATE_SENT", "RSA"),
+    "PUT AWAY FILES": ("putaway", "DATE_SENT", None),
+    "COURT GOING FILES": ("court_going", "DATE_SENT_TO_COURT", None),
+    "FILES ALLOCATED TO INVESTIGATORS": (
+        "allocation", "DATE_OF_ALLOCATION", None),
+}
+
+
+def date_range_query(dept, start, end, keyed=False):
+    # Rows of dept dated start <= date < end, as a plain range on the
+    # date column so SQLite can seek the index instead of scanning.
+    # Keyed rows end with ROW_KEY, as a RowSource needs.
+    try:
+        table, column, sent_to = DEPARTMENTS[dept]
+    except KeyError:
+        raise ValueError("Choose which files to analyse")
+
+    if keyed:
+        table = TABLES[table].queries.keyed
+    SQL = "SELECT * FROM %s WHERE %s >= ? AND %s < ?" % (table, column, column)
+    params = (start.isoformat(), end.isoformat())
+    if sent_to:
+        SQL += " AND FILE_SENT_TO = ?"
+        params += (sent_to,)
+    return SQL, params
+
+
+# Full-text index over the people and offence of each file. It keeps
+# only the index; the text is read from files, whose triggers keep the
+# two in step.
+SEARCH_COLUMNS = ("COMPLAINANT", "SUSPECT", "OFFENCE", "INVESTIGATING_OFFICER")
+
+SEARCH_LIMIT = 500
+
+
+def create_search_index(conn):
+    conn.execute("""
+        CREATE VIRTUAL TABLE file_search USING fts5(
+        COMPLAINANT, SUSPECT, OFFENCE, INVESTIGATING_OFFICER,
+        content = 'files', content_rowid = 'ID',
+        tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')
+        """)
+    conn.execute("INSERT INTO file_search (file_search) VALUES ('rebuild')")
+
+    columns = ", ".join(SEARCH_COLUMNS)
+
+    def values(row):
+        return ", ".join("%s.%s" % (row, c) for c in ("ID",) + SEARCH_COLUMNS)
+
+    insert = "INSERT INTO file_search (rowid, %s) VALUES (%s)" % (
+        columns, values("new"))
+    delete = """INSERT INTO file_search (file_search, rowid, %s)
+        VALUES ('delete', %s)""" % (columns, values("old"))
+
+    conn.execute("""CREATE TRIGGER files_search_insert AFTER INSERT ON files
+        BEGIN %s; END""" % insert)
+    conn.execute("""CREATE TRIGGER files_search_update AFTER UPDATE OF %s
+        ON files BEGIN %s; %s; END""" % (columns, delete, insert))
+    conn.execute("""CREATE TRIGGER files_search_delete AFTER DELETE ON files
+        BEGIN %s; END""" % delete)
+
+
+def search_query(text, limit=SEARCH_LIMIT):
+    # Every word typed must match the start of a word in one of the
+    # indexed columns; best matches first. A file is listed once for
+    # each department it has been through.
+    terms = re.findall(r"\w+", text)
+    if not terms:
+        raise ValueError("Enter a name, offence or officer to search for")
+
+    SQL = """SELECT %s AS REF, m.DEPARTMENT, f.COMPLAINANT, f.SUSPECT,
+        f.OFFENCE, f.INVESTIGATING_OFFICER FROM file_search
+        JOIN files f ON f.ID = file_search.rowid
+        JOIN movements m ON m.FILE_ID = f.ID
+        WHERE file_search MATCH ? ORDER BY file_search.rank LIMIT ?""" % (
+        department_ref("m", "f"))
+    return SQL, (" ".join('"%s"*' % t for t in terms), limit)
+
+
+# Summary groupings: the SQL expression each one counts by. {date} is
+# the department's date column.
+GROUPS = OrderedDict([
+    ("MONTH", "substr({date}, 1, 7)"),
+    ("YEAR", "substr({date}, 1, 4)"),
+    ("DEPARTMENT", None),
+    ("OFFENCE", "OFFENCE"),
+    ("OFFICER", "INVESTIGATING_OFFICER"),
+    ("DESTINATION", "FILE_SENT_TO"),
+])
+
+
+def summary_query(dept, group, start, end):
+    # COUNT(*) per group over the period; only the counts leave SQLite
+    period = (start.isoformat(), end.isoformat())
+
+    if group == "DEPARTMENT":
+        parts, params = [], ()
+        for name, (table, column, sent_to) in DEPARTMENTS.items():
+            SQL = "SELECT ? AS DEPARTMENT, COUNT(*) AS FILES FROM %s" \
+                " WHERE %s >= ? AND %s < ?" % (table, column, column)
+            params += (name,) + period
+            if sent_to:
+                SQL += " AND FILE_SENT_TO = ?"
+                params += (sent_to,)
+            parts.append(SQL)
+        return " UNION ALL ".join(parts), params
+
+    try:
+        table, column, sent_to = DEPARTMENTS[dept]
+        expr = GROUPS[group].format(date=column)
+    except KeyError:
+        raise ValueError("Choose which files and what to group them by")
+
+    SQL = "SELECT %s AS %s, COUNT(*) AS FILES FROM %s WHERE %s >= ? AND %s < ?" % (
+        expr, group, table, column, column)
+    params = period
+    if sent_to and group != "DESTINATION":
+        SQL += " AND FILE_SENT_TO = ?"
+        params += (sent_to,)
+
+    SQL += " GROUP BY 1"
+    if group in ("MONTH", "YEAR"):
+        SQL += " ORDER BY 1"
+    else:
+        SQL += " ORDER BY FILES DESC, 1"
+    return SQL, params
+
+
+def group_detail_query(dept, group, value, start, end, keyed=False):
+    # The files behind one row of a summary
+    if group == "DEPARTMENT":
+        return date_range_query(value, start, end, keyed)
+
+    SQL, params = date_range_query(dept, start, end, keyed)
+    if group == "DESTINATION":
+        # The group replaces the DPP/RSA filter
+        SQL, params = SQL.replace(" AND FILE_SENT_TO = ?", ""), params[:2]
+    column = DEPARTMENTS[dept][1]
+    return SQL + " AND %s IS ?" % GROUPS[group].format(date=column), \
+        params + (value,)
+
+
+def missing_columns(conn, dept, group):
+    expr = GROUPS.get(group)
+    if not expr or dept not in DEPARTMENTS:
+        return False
+    table = DEPARTMENTS[dept][0]
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(%s)" % table)]
+    return "{" not in expr and expr not in columns
+
+
+# Rollup of file counts per (department table, destination, year, month)
+# kept current by triggers on movements, so period totals are a few key
+# lookups. Only these departments count by destination (their PLACE).
+ROLLUP_DESTINATIONS = ("files_sent_to_dpp",)
+
+
+def rollup_keys(row):
+    # (department, destination, year, month) of a movement; dates that
+    # are not ISO-8601 are counted under an empty year and month
+    iso = "%s.DATE GLOB '%s'" % (row, ISO_DATE_GLOB)
+    return ("%s.DEPARTMENT" % row,
+        "CASE WHEN %s.DEPARTMENT IN (%s) THEN COALESCE(%s.PLACE, '')"
+        " ELSE '' END" % (row, ", ".join("'%s'" % d
+            for d in ROLLUP_DESTINATIONS), row),
+        "CASE WHEN %s THEN substr(%s.DATE, 1, 4) ELSE '' END" % (iso, row),
+        "CASE WHEN %s THEN substr(%s.DATE, 6, 2) ELSE '' END" % (iso, row))
+
+
+def create_rollups(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS file_counts
+        (DEPARTMENT TEXT, DESTINATION TEXT, YEAR TEXT, MONTH TEXT,
+        FILES INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (DEPARTMENT, DESTINATION, YEAR, MONTH)) WITHOUT ROWID
+        """)
+    rebuild_rollups(conn)
+
+    def change(row, delta):
+        return """INSERT INTO file_counts VALUES (%s, %s)
+            ON CONFLICT (DEPARTMENT, DESTINATION, YEAR, MONTH)
+            DO UPDATE SET FILES = FILES + %s""" % (
+            ", ".join(rollup_keys(row)), delta, delta)
+
+    conn.execute("""CREATE TRIGGER movements_counts_insert AFTER INSERT
+        ON movements BEGIN %s; END""" % change("new", 1))
+    conn.execute("""CREATE TRIGGER movements_counts_update AFTER UPDATE
+        OF DEPARTMENT, DATE, PLACE ON movements BEGIN %s; %s; END""" % (
+        change("old", -1), change("new", 1)))
+    conn.execute("""CREATE TRIGGER movements_counts_delete AFTER DELETE
+        ON movements BEGIN %s; END""" % change("old", -1))
+
+
+@timed
+def rebuild_rollups(conn):
+    # Recounts every department from scratch
+    conn.execute("DELETE FROM file_counts")
+    conn.execute("""INSERT INTO file_counts
+        SELECT %s, COUNT(*) FROM movements GROUP BY 1, 2, 3, 4""" % (
+        ", ".join(rollup_keys("movements"))))
+
+
+def rollup_filter(dept, start, end, destination=True):
+    table, column, sent_to = DEPARTMENTS[dept]
+    SQL = "DEPARTMENT = ? AND (YEAR, MONTH) >= (?, ?) AND (YEAR, MONTH) < (?, ?)"
+    params = (table, start.strftime("%Y"), start.strftime("%m"),
+        end.strftime("%Y"), end.strftime("%m"))
+    if destination:
+        SQL += " AND DESTINATION = ?"
+        params += (sent_to or "",)
+    return SQL, params
+
+
+def whole_months(start, end):
+    return start.day == 1 and end.day == 1
+
+
+def period_count_query(dept, start, end):
+    # Number of files of dept in the period, from the rollup when the
+    # period is made of whole months
+    if dept in DEPARTMENTS and whole_months(start, end):
+        where, params = rollup_filter(dept, start, end)
+        return "SELECT COALESCE(SUM(FILES), 0) FROM file_counts WHERE " + \
+            where, params
+
+    SQL, params = date_range_query(dept, start, end)
+    return "SELECT COUNT(*) FROM (%s)" % SQL, params
+
+
+def rollup_summary_query(dept, group, start, end):
+    # summary_query answered from the rollup. Only month, year, department
+    # and destination groups over whole months can be.
+    if not whole_months(start, end) or group not in (
+            "MONTH", "YEAR", "DEPARTMENT", "DESTINATION"):
+        return None
+
+    if group == "DEPARTMENT":
+        parts, params = [], ()
+        for name in DEPARTMENTS:
+            where, values = rollup_filter(name, start, end)
+            parts.append("SELECT ? AS DEPARTMENT, COALESCE(SUM(FILES), 0)"
+                " AS FILES FROM file_counts WHERE " + where)
+            params += (name,) + values
+        return " UNION ALL ".join(parts), params
+
+    if dept not in DEPARTMENTS:
+        return None
+    where, params = rollup_filter(dept, start, end, group != "DESTINATION")
+    expr = {"MONTH": "YEAR || '-' || MONTH", "YEAR": "YEAR",
+        "DESTINATION": "DESTINATION"}[group]
+    SQL = "SELECT %s AS %s, SUM(FILES) AS FILES FROM file_counts WHERE %s" \
+        " GROUP BY 1 HAVING SUM(FILES) > 0" % (expr, group, where)
+    if group == "DESTINATION":
+        return SQL + " ORDER BY FILES DESC, 1", params
+    return SQL + " ORDER BY 1", params
+
+
+@timed
+def dashboard_counts(conn, today):
+    # Files per department this month, this year and in all, straight
+    # from the rollup
+    this_month = month_bounds(today.month, today.year)
+    this_year = year_bounds(today.year)
+    rows = []
+    for name, (table, column, sent_to) in DEPARTMENTS.items():
+        row = [name]
+        for start, end in (this_month, this_year):
+            where, params = rollup_filter(name, start, end)
+            row.append(conn.execute("SELECT COALESCE(SUM(FILES), 0)"
+                " FROM file_counts WHERE " + where, params).fetchone()[0])
+        row.append(conn.execute("SELECT COALESCE(SUM(FILES), 0) FROM file_counts"
+            " WHERE DEPARTMENT = ? AND DESTINATION = ?",
+            (table, sent_to or "")).fetchone()[0])
+        rows.append(tuple(row))
+    return rows
+
+
+def month_bounds(month, year):
+    start = date(int(year), int(month), 1)
+    if start.month == 12:
+        return start, date(start.year + 1, 1, 1)
+    return start, date(start.year, start.month + 1, 1)
+
+
+def year_bounds(year):
+    return date(int(year), 1, 1), date(int(year) + 1, 1, 1)
+
+
+# The details every department records about a file, stored once per
+# file in files. Everything else a department records is in its movement.
+FILE_COLUMNS = ("CURRENT_REF_NO", "COMPLAINANT", "SUSPECT", "OFFENCE",
+    "INVESTIGATING_OFFICER")
+
+FILES_SCHEMA = """
+    CREATE TABLE files
+    (ID INTEGER PRIMARY KEY,
+    REF VARCHAR(15) NOT NULL UNIQUE,
+    CURRENT_REF_NO VARCHAR(15),
+    COMPLAINANT VARCHAR(30),
+    SUSPECT VARCHAR(30),
+    OFFENCE VARCHAR(50),
+    INVESTIGATING_OFFICER VARCHAR(30))
+    """
+
+# One row per department a file has been through. DATE is when it was
+# sent, allocated or went to court, NEXT_DATE when it came back from the
+# DPP or is next in court, PLACE where it was sent or is kept, and NOTE
+# the remarks or status.
+MOVEMENTS_SCHEMA = """
+    CREATE TABLE movements
+    (ID INTEGER PRIMARY KEY,
+    FILE_ID INTEGER NOT NULL REFERENCES files (ID),
+    DEPARTMENT VARCHAR(20) NOT NULL,
+    DATE DATE,
+    NEXT_DATE DATE,
+    PLACE VARCHAR(30),
+    NOTE VARCHAR(200),
+    UNIQUE (FILE_ID, DEPARTMENT))
+    """
+
+
+def department_ref(move, file):
+    # The ref number a department's form knows a file by
+    by_current = [t.name for t in TABLES.values()
+        if t.queries.key == "CURRENT_REF_NO"]
+    return "CASE WHEN %s.DEPARTMENT IN (%s) THEN %s.CURRENT_REF_NO" \
+        " ELSE %s.REF END" % (move, ", ".join("'%s'" % t for t in by_current),
+        file, file)
+
+
+class TableQueries:
+    # Parameterized SQL for one department, built once so every call
+    # reuses the same statement text. Reads go through the department's
+    # view; writes go to files and movements.
+    def __init__(self, table):
+        name = self.table = table.name
+        self.columns = [column_name(f) for f in table.fields]
+        if "ORIGINAL_REF_NO" in self.columns:
+            self.key, file_key = "ORIGINAL_REF_NO", "REF"
+        else:
+            self.key, file_key = "CURRENT_REF_NO", "CURRENT_REF_NO"
+        self.file_key = file_key
+        self.details = [c for c in self.columns if c in FILE_COLUMNS]
+        self.moves = [c for c in self.columns if c in table.movement]
+        moved = [table.movement[c] for c in self.moves]
+
+        # A blank detail keeps what another department recorded
+        self.store_file = """INSERT INTO files (REF, %s) VALUES (?%s)
+            ON CONFLICT (REF) DO UPDATE SET %s RETURNING ID""" % (
+            ", ".join(self.details), ", ?" * len(self.details),
+            ", ".join("%s = COALESCE(NULLIF(excluded.%s, ''), %s)" % (c, c, c)
+                for c in self.details))
+        # The form's Update writes what was typed, blanks included
+        self.update_file = "UPDATE files SET %s WHERE ID = ?" % ", ".join(
+            "%s = ?" % c for c in self.details)
+        # Files known only by their current ref number
+        self.file_ref = "SELECT REF FROM files WHERE CURRENT_REF_NO = ?" \
+            " ORDER BY ID LIMIT 1"
+        # Another file already known by a current ref number
+        self.taken = "SELECT ID, REF FROM files WHERE CURRENT_REF_NO = ?" \
+            " AND REF <> ? LIMIT 1"
+
+        self.insert_move = """INSERT INTO movements (FILE_ID, DEPARTMENT, %s)
+            VALUES (?, '%s', %s)""" % (", ".join(moved), name,
+            ", ".join("?" * len(moved)))
+        self.add_move = self.insert_move + \
+            " ON CONFLICT (FILE_ID, DEPARTMENT) DO NOTHING RETURNING ID"
+        assign = ", ".join("%s = ?" % c for c in moved)
+        self.update_move = "UPDATE movements SET %s WHERE FILE_ID = ?" \
+            " AND DEPARTMENT = '%s'" % (assign, name)
+        of_file = "DEPARTMENT = '%s' AND FILE_ID IN" \
+            " (SELECT ID FROM files WHERE %s = ?)" % (name, file_key)
+        self.update = "UPDATE movements SET %s WHERE %s RETURNING FILE_ID" % (
+            assign, of_file)
+        self.delete = "DELETE FROM movements WHERE " + of_file
+
+        self.select_all = "SELECT * FROM %s" % name
+        self.dates = [i for i, c in enumerate(self.columns)
+            if c.startswith("DATE_")]
+
+        # The department as it used to be stored, column for column
+        source = []
+        for c in self.columns:
+            if c == "ORIGINAL_REF_NO":
+                source.append("f.REF AS ORIGINAL_REF_NO")
+            elif c in FILE_COLUMNS:
+                source.append("f.%s AS %s" % (c, c))
+            else:
+                source.append("m.%s AS %s" % (table.movement[c], c))
+        self.source = ", ".join(source)
+        self.view = """CREATE VIEW %s AS SELECT %s FROM movements m
+            JOIN files f ON f.ID = m.FILE_ID WHERE m.DEPARTMENT = '%s'""" % (
+            name, self.source, name)
+        # The view's rows with their movement ID as ROW_KEY, for reads
+        # that must pick up where they left off
+        self.keyed = """(SELECT %s, m.ID AS ROW_KEY FROM movements m
+            JOIN files f ON f.ID = m.FILE_ID WHERE m.DEPARTMENT = '%s')""" % (
+            self.source, name)
+
+        # Lookups by ref number start from files; through the view the
+        # planner may walk the department's movements instead
+        lookup = """FROM files f CROSS JOIN movements m ON m.FILE_ID = f.ID
+            WHERE f.%s = ? AND m.DEPARTMENT = '%s'""" % (file_key, name)
+        self.select = "SELECT %s %s" % (self.source, lookup)
+
+    def normalise(self, values):
+        values = list(values)
+        for i in self.dates:
+            if i < len(values):
+                values[i] = iso_date(values[i])
+        return tuple(values)
+
+    _built = {}
+
+    @classmethod
+    def get(cls, table):
+        queries = cls._built.get(table.name)
+        if queries is None:
+            queries = cls._built[table.name] = cls(table)
+        return queries
+
+
+class Table:
+    # A department: its form fields, the table and date index it had
+    # before files were normalised, and which movement column holds each
+    # of its own fields
+    def __init__(self, name, title, fields, schema, date_index, movement):
+        self.name = name
+        self.title = title
+        self.fields = fields
+        self.schema = schema
+        self.date_index = date_index
+        self.movement = movement
+
+    @property
+    def queries(self):
+        return TableQueries.get(self)
+
+
+TABLES = OrderedDict((t.name, t) for t in [
+    Table("files_sent_to_dpp", "Files Sent to DPP/RSA", [
+        "Original REF NO", "Current REF NO",
+        "Complainant", "Suspect", "Offence",
+        "Investigating Officer",
+        "Date Sent", 
+        "Date Returned",
+        "File Sent To", 
+        "Remarks"], '''
+        CREATE TABLE IF NOT EXISTS files_sent_to_dpp
+        (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
+        CURRENT_REF_NO VARCHAR(15) UNIQUE,
+        COMPLAINANT VARCHAR(30), 
+        SUSPECT VARCHAR(30), 
+        OFFENCE VARCHAR(50),
+        INVESTIGATING_OFFICER VARCHAR(30), 
+        DATE_SENT DATE, 
+        DATE_RETURNED DATE(15),
+        FILE_SENT_TO VARCHAR(20),
+        REMARKS VARCHAR(200))
+        ''', ("FILE_SENT_TO", "DATE_SENT"), {"DATE_SENT": "DATE",
+        "DATE_RETURNED": "NEXT_DATE", "FILE_SENT_TO": "PLACE",
+        "REMARKS": "NOTE"}),
+
+    Table("court_going", "Court Going Files", [
+        "Current REF NO",
+        "Complainant", "Suspect", "Offence",
+        "Investigating Officer",
+        "Date Sent to Court", 
+        "Date Next in Court", 
+        "Status Of Case"], '''
+        CREATE TABLE IF NOT EXISTS court_going
+        ( 
+        CURRENT_REF_NO VARCHAR(15) PRIMARY KEY,
+        COMPLAINANT VARCHAR(30), 
+        SUSPECT VARCHAR(30), 
+        OFFENCE VARCHAR(50),
+        INVESTIGATING_OFFICER VARCHAR(30), 
+        DATE_SENT_TO_COURT DATE, 
+        DATE_NEXT_IN_COURT DATE, 
+        STATUS_OF_CASE VARCHAR(30))
+        ''', ("DATE_SENT_TO_COURT",), {"DATE_SENT_TO_COURT": "DATE",
+        "DATE_NEXT_IN_COURT": "NEXT_DATE", "STATUS_OF_CASE": "NOTE"}),
+
+    Table("putaway", "Put Away Files", [
+        "Original REF NO", "Current REF NO",
+        "Complainant", "Suspect", "Offence",
+        "Location of File", "Status", "Date Sent"], '''
+        CREATE TABLE IF NOT EXISTS putaway
+        (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
+        CURRENT_REF_NO VARCHAR(15) UNIQUE,
+        COMPLAINANT VARCHAR(30), 
+        SUSPECT VARCHAR(30), 
+        OFFENCE VARCHAR(50),
+        LOCATION_OF_FILE VARCHAR(30), 
+        STATUS VARCHAR(30), 
+        DATE_SENT DATE)
+        ''', ("DATE_SENT",), {"LOCATION_OF_FILE": "PLACE", "STATUS": "NOTE",
+        "DATE_SENT": "DATE"}),
+
+    Table("allocation", "Allocation To Investigators", [
+        "Original REF NO", "Current REF NO",
+        "Complainant", "Suspect", "Offence",
+        "Investigating Officer", "Date of Allocation"], '''
+        CREATE TABLE IF NOT EXISTS allocation
+        (ORIGINAL_REF_NO VARCHAR(15) PRIMARY KEY, 
+        CURRENT_REF_NO VARCHAR(15) UNIQUE,
+        COMPLAINANT VARCHAR(30), 
+        SUSPECT VARCHAR(30), 
+        OFFENCE VARCHAR(50),
+        INVESTIGATING_OFFICER VARCHAR(30), 
+        DATE_OF_ALLOCATION DATE)
+        ''', ("DATE_OF_ALLOCATION",), {"DATE_OF_ALLOCATION": "DATE"}),
+])
+
+
+# Schema changes in the order they were made. A database records how
+# many it has had in PRAGMA user_version, so opening an up to date one
+# costs a single pragma read. Each step must also cope with databases
+# from before versioning, which may already have some of its objects.
+
+def schema_has(conn, kind, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = ?"
+        " AND name = ?", (kind, name)).fetchone() is not None
+
+
+def create_tables(conn):
+    for table in TABLES.values():
+        conn.execute(table.schema)
+
+
+def index_dates(conn):
+    # Free-text dates from older versions are rewritten to ISO-8601
+    # before the index over them is built
+    for table in TABLES.values():
+        name = "%s_dates" % table.name
+        if not schema_has(conn, "index", name):
+            migrate_dates(conn, table.name)
+            conn.execute("CREATE INDEX %s ON %s (%s)" % (
+                name, table.name, ", ".join(table.date_index)))
+
+
+def normalise_files(conn):
+    # The details each department repeated become one row per file in
+    # files, and each department's own columns a row in movements. The
+    # department tables give way to views of the same name and columns,
+    # and those with rows are kept as <name>_legacy: where departments
+    # disagreed about a file's details the last one read wins, and the
+    # others' are only there. Returns the rows that disagreed or could
+    # not be moved.
+    conn.execute(FILES_SCHEMA)
+    conn.execute(MOVEMENTS_SCHEMA)
+    conn.execute("CREATE INDEX files_current_ref ON files (CURRENT_REF_NO)")
+    conn.execute("CREATE INDEX movements_dates ON movements (DEPARTMENT, DATE)")
+
+    # Departments that only know the current ref number go last, so
+    # their rows can join files the others have recorded
+    cur = conn.cursor()
+    conflicts = []
+    for table in sorted(TABLES.values(),
+            key=lambda t: t.queries.key != "ORIGINAL_REF_NO"):
+        queries = table.queries
+        key = queries.columns.index(queries.key)
+        details = "SELECT %s FROM files WHERE %s = ? ORDER BY ID LIMIT 1" % (
+            ", ".join(queries.details), queries.file_key)
+        for values in conn.execute("SELECT %s FROM %s" % (
+                ", ".join(queries.columns), table.name)):
+            if values[key] is None:
+                values = values[:key] + ("",) + values[key + 1:]
+            row = dict(zip(queries.columns, values))
+            stored = cur.execute(details, (values[key],)).fetchone()
+            if stored and any(old and row[c] and old != row[c]
+                    for c, old in zip(queries.details, stored)):
+                conflicts.append("%s %s" % (table.name, values[key]))
+            try:
+                store_record(cur, queries, values)
+            except sqlite3.IntegrityError as e:
+                conflicts.append("%s %s (not moved: %s)" % (
+                    table.name, values[key], e))
+
+        if conn.execute("SELECT 1 FROM %s LIMIT 1" % table.name).fetchone():
+            for (trigger,) in conn.execute("SELECT name FROM sqlite_master"
+                    " WHERE type = 'trigger' AND tbl_name = ?",
+                    (table.name,)).fetchall():
+                conn.execute("DROP TRIGGER %s" % trigger)
+            conn.execute("ALTER TABLE %s RENAME TO %s_legacy" % (
+                table.name, table.name))
+        else:
+            conn.execute("DROP TABLE %s" % table.name)
+        conn.execute(queries.view)
+
+    conn.execute("""CREATE TRIGGER movements_forget_file AFTER DELETE
+        ON movements WHEN NOT EXISTS
+        (SELECT 1 FROM movements WHERE FILE_ID = old.FILE_ID)
+        BEGIN DELETE FROM files WHERE ID = old.FILE_ID; END""")
+
+    conn.execute("DROP TABLE IF EXISTS file_search")
+    create_search_index(conn)
+    create_rollups(conn)
+    return conflicts
+
+
+# Saves use INSERT ... RETURNING, which came in SQLite 3.35 (Python 3.10
+# and newer bundle it on Windows)
+SQLITE_VERSION = (3, 35, 0)
+
+MIGRATIONS = [
+    create_tables,
+    index_dates,
+    normalise_files,
+]
+
+# Heads the rows migrate() returns
+MIGRATION_CONFLICTS = ("These department rows disagreed with another"
+    " department about a file, or could not be moved. The rows as they"
+    " were are kept in the *_legacy tables:")
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate():
+    # Brings the database up to date; called once at startup. The
+    # migrations run in one write transaction so a second FMS starting
+    # at the same time waits and then finds nothing left to do. Returns
+    # the department rows a migration could not carry over as they were,
+    # for the caller to show under MIGRATION_CONFLICTS.
+    if sqlite3.sqlite_version_info < SQLITE_VERSION:
+        raise sqlite3.NotSupportedError("FMS needs SQLite %s or newer; this"
+            " Python has SQLite %s. Install a newer Python." % (
+            ".".join(map(str, SQLITE_VERSION)), sqlite3.sqlite_version))
+    conflicts = []
+    with Connection() as conn:
+        if schema_version(conn) >= len(MIGRATIONS):
+            return conflicts
+
+        conn.execute("BEGIN IMMEDIATE")
+        version = schema_version(conn)
+        for number in range(version, len(MIGRATIONS)):
+            conflicts += MIGRATIONS[number](conn) or []
+            conn.execute("PRAGMA user_version = %d" % (number + 1))
+    lookups.clear()
+    return conflicts
+
+
+# Lookups kept by LookupCache
+LOOKUP_CACHE_SIZE = 256
+
+
+class LookupCache:
+    """Recent finds and searches, kept until the database changes.
+
+    Writes made through this module clear it. Commits by other processes,
+    and by this process's other connections, show up as a change of
+    PRAGMA data_version on a connection kept for watching.
+    """
+
+    def __init__(self, size=LOOKUP_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.entries = OrderedDict()
+        self.generation = 0
+        self.watch = None
+        self.version = None
+        self._lock = threading.Lock()
+
+    def _clear(self):
+        if self.entries:
+            self.invalidations += 1
+            self.entries.clear()
+        self.generation += 1
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _check(self):
+        try:
+            version = self.watch.execute("PRAGMA data_version").fetchone()[0]
+        except (AttributeError, sqlite3.ProgrammingError):
+            # First use, or the manager has closed its connections
+            self.watch = manager.connect()
+            version = None
+        if version is None or version != self.version:
+            self._clear()
+            self.version = self.watch.execute(
+                "PRAGMA data_version").fetchone()[0]
+
+    def cached(self, key, load):
+        # The value for key, calling load() on a miss. A value loaded
+        # while the cache was cleared is returned but not kept.
+        with self._lock:
+            self._check()
+            if key in self.entries:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return self.entries[key]
+            self.misses += 1
+            generation = self.generation
+
+        value = load()
+        with self._lock:
+            if generation == self.generation:
+                self.entries[key] = value
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+        return value
+
+    def stats(self):
+        return {"size": self.size, "entries": len(self.entries),
+            "hits": self.hits, "misses": self.misses,
+            "invalidations": self.invalidations}
+
+
+lookups = LookupCache()
+
+
+# Entries that suggest values already recorded, and how many they show
+COMPLETION_COLUMNS = ("COMPLAINANT", "SUSPECT", "OFFENCE",
+    "INVESTIGATING_OFFICER")
+COMPLETION_LIMIT = 10
+
+
+class PrefixIndex:
+    # Distinct values of one column sorted without regard to case, so
+    # the values starting with a prefix are one binary search away
+    def __init__(self, values):
+        pairs = sorted((v.casefold(), v) for v in set(map(str, values)) if v)
+        self.keys = [key for key, value in pairs]
+        self.values = [value for key, value in pairs]
+        self.known = set(self.values)
+
+    def add(self, value):
+        if not value:
+            return
+        value = str(value)
+        if value in self.known:
+            return
+        i = bisect.bisect_left(self.keys, value.casefold())
+        self.keys.insert(i, value.casefold())
+        self.values.insert(i, value)
+        self.known.add(value)
+
+    def complete(self, prefix, limit=COMPLETION_LIMIT):
+        prefix = prefix.casefold()
+        found = []
+        i = bisect.bisect_left(self.keys, prefix)
+        while i < len(self.keys) and len(found) < limit and \
+                self.keys[i].startswith(prefix):
+            found.append(self.values[i])
+            i += 1
+        return found
+
+
+class Completions:
+    # One PrefixIndex per column, read from files the first time the
+    # column is completed and kept up to date as records are saved
+    def __init__(self):
+        self.indexes = {}
+
+    def complete(self, column, prefix, limit=COMPLETION_LIMIT):
+        index = self.indexes.get(column)
+        if index is None:
+            with Connection() as conn:
+                values = [r[0] for r in conn.execute("SELECT DISTINCT %s"
+                    " FROM files WHERE %s <> ''" % (column, column))]
+            index = self.indexes[column] = PrefixIndex(values)
+        return index.complete(prefix, limit)
+
+    def learn(self, record):
+        for column, index in list(self.indexes.items()):
+            index.add(record.get(column))
+
+    def clear(self):
+        self.indexes = {}
+
+
+completions = Completions()
+
+
+# Records. Values are tuples in the order of the table's fields.
+
+@timed
+def find_record(table, ref):
+    # The record as a dict of column values, or None
+    def load():
+        with Connection() as conn:
+            cur = conn.cursor()
+            cur.execute(TABLES[table].queries.select, (ref,))
+            return returned(cur)
+
+    record = lookups.cached(("find", table, ref), load)
+    return dict(record) if record else None
+
+
+def check_current_ref(cur, queries, row, adopt=False):
+    # Court going finds files by their current ref number alone, so no
+    # two files may share one. Raises IntegrityError if another has it,
+    # unless adopt is set and that file is only court going's record of
+    # this one, made before the original ref was known.
+    current = row.get("CURRENT_REF_NO")
+    if queries.key != "ORIGINAL_REF_NO" or not current:
+        return
+    ref = row[queries.key]
+    found = cur.execute(queries.taken, (current, ref)).fetchone()
+    if not found:
+        return
+    if adopt and found[1] == current and adopt_file(cur, found[0], ref):
+        return
+    raise sqlite3.IntegrityError("CURRENT_REF_NO %s is already file %s's"
+        % (current, found[1]))
+
+
+def adopt_file(cur, file_id, ref):
+    # Gives ref the file court going recorded under its current ref: the
+    # file is renamed, or its movements join the file already under ref.
+    # False if it is not such a file or both went to court.
+    by_current = [t.name for t in TABLES.values()
+        if t.queries.key == "CURRENT_REF_NO"]
+    others = cur.execute("SELECT 1 FROM movements WHERE FILE_ID = ?"
+        " AND DEPARTMENT NOT IN (%s)" % ", ".join("?" * len(by_current)),
+        (file_id,) + tuple(by_current)).fetchone()
+    if others:
+        return False
+
+    existing = cur.execute("SELECT ID FROM files WHERE REF = ?",
+        (ref,)).fetchone()
+    if existing is None:
+        cur.execute("UPDATE files SET REF = ? WHERE ID = ?", (ref, file_id))
+        return True
+    if cur.execute("SELECT 1 FROM movements WHERE FILE_ID = ? AND DEPARTMENT"
+            " IN (SELECT DEPARTMENT FROM movements WHERE FILE_ID = ?)",
+            (existing[0], file_id)).fetchone():
+        return False
+    cur.execute("UPDATE movements SET FILE_ID = ? WHERE FILE_ID = ?",
+        (existing[0], file_id))
+    cur.execute("DELETE FROM files WHERE ID = ?", (file_id,))
+    return True
+
+
+def store_record(cur, queries, values, replace=True):
+    # Writes one department row: the file's details, then its movement.
+    # Returns True if the movement is new. Without replace a movement
+    # already recorded raises IntegrityError.
+    row = dict(zip(queries.columns, values))
+    ref = row[queries.key]
+    if queries.key != "ORIGINAL_REF_NO":
+        found = cur.execute(queries.file_ref, (ref,)).fetchone()
+        if found:
+            ref = found[0]
+    check_current_ref(cur, queries, row, True)
+    cur.execute(queries.store_file,
+        (ref,) + tuple(row[c] for c in queries.details))
+    file_id = cur.fetchone()[0]
+
+    moves = tuple(row[c] for c in queries.moves)
+    if not replace:
+        cur.execute(queries.insert_move, (file_id,) + moves)
+        return True
+    cur.execute(queries.add_move, (file_id,) + moves)
+    if cur.fetchall():
+        return True
+    cur.execute(queries.update_move, moves + (file_id,))
+    return False
+
+
+def returned(cur):
+    # The row a statement gave back as a dict, or None
+    rows = cur.fetchall()
+    if not rows:
+        return None
+    return dict(zip([d[0] for d in cur.description], rows[0]))
+
+
+# save_now, update_now and delete_now write on the calling thread's
+# connection; the window and the server go through the write queue below,
+# and save_record and friends update the caches once it has committed.
+def save_now(table, values):
+    queries = TABLES[table].queries
+    values = queries.normalise(values)
+    with Connection() as conn:
+        cur = conn.cursor()
+        created = store_record(cur, queries, values)
+        cur.execute(queries.select, (values[queries.columns.index(queries.key)],))
+        return created, returned(cur)
+
+
+def update_now(table, values):
+    queries = TABLES[table].queries
+    row = dict(zip(queries.columns, queries.normalise(values)))
+    ref = row[queries.key]
+    with Connection() as conn:
+        cur = conn.cursor()
+        check_current_ref(cur, queries, row)
+        cur.execute(queries.update,
+            tuple(row[c] for c in queries.moves) + (ref,))
+        moved = cur.fetchall()
+        if not moved:
+            return None
+        cur.execute(queries.update_file,
+            tuple(row[c] for c in queries.details) + (moved[0][0],))
+        cur.execute(queries.select, (ref,))
+        return returned(cur)
+
+
+def delete_now(table, ref):
+    with Connection() as conn:
+        deleted = conn.execute(TABLES[table].queries.delete, (ref,)).rowcount
+        return deleted > 0
+
+
+# Saves, updates and deletes waiting in the write queue are committed
+# together, up to this many in one transaction
+WRITE_BATCH = 100
+
+# A batch that finds the database locked is tried again this many times,
+# waiting WRITE_BACKOFF seconds the first time and twice as long each time
+WRITE_RETRIES = 3
+WRITE_BACKOFF = 0.1
+
+
+def busy(error):
+    # Another connection, usually another workstation, holds the write lock
+    code = getattr(error, "sqlite_errorcode", None)
+    if code is not None:
+        return code & 0xff in (sqlite3.SQLITE_BUSY, sqlite3.SQLITE_LOCKED)
+    return "locked" in str(error) or "busy" in str(error)
+
+
+class WriteQueue:
+    # Runs the writes of every thread on one writer thread. Whatever is
+    # waiting when it wakes is committed in a single transaction, each
+    # write inside its own savepoint so a failing one is undone alone and
+    # its caller gets the error while the rest are kept.
+    def __init__(self, batch=WRITE_BATCH, retries=WRITE_RETRIES,
+            backoff=WRITE_BACKOFF):
+        self.batch = batch
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = queue.Queue()
+        self.thread = None
+        self.commits = 0
+        self.writes = 0
+        self.retried = 0
+        self._lock = threading.Lock()
+
+    def run(self, func, *args):
+        # Waits for func(*args) to be committed and returns what it returned
+        if threading.current_thread() is self.thread or \
+                getattr(manager.local, "depth", 0):
+            # Already inside a transaction; queueing would wait on itself
+            return func(*args)
+        future = Future()
+        self.pending.put((future, func, args))
+        with self._lock:
+            # Also after a fork, which leaves the writer behind
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.work,
+                    name="fms-writes", daemon=True)
+                self.thread.start()
+        return future.result()
+
+    def work(self):
+        while True:
+            batch = [self.pending.get()]
+            while len(batch) < self.batch:
+                try:
+                    batch.append(self.pending.get_nowait())
+                except queue.Empty:
+                    break
+            batch = [item for item in batch
+                if item[0].set_running_or_notify_cancel()]
+            if batch:
+                self.commit(batch)
+
+    def commit(self, batch):
+        for attempt in range(self.retries + 1):
+            try:
+                outcomes = self.apply(batch)
+                break
+            except sqlite3.OperationalError as e:
+                if not busy(e) or attempt == self.retries:
+                    for future, func, args in batch:
+                        future.set_exception(e)
+                    return
+                self.retried += 1
+                time.sleep(self.backoff * 2 ** attempt *
+                    random.uniform(0.5, 1.5))
+            except Exception as e:
+                for future, func, args in batch:
+                    future.set_exception(e)
+                return
+
+        self.commits += 1
+        self.writes += len(batch)
+        for (future, func, args), (failed, outcome) in zip(batch, outcomes):
+            if failed:
+                future.set_exception(outcome)
+            else:
+                future.set_result(outcome)
+
+    def apply(self, batch):
+        # Raises only when the whole batch has to be tried again
+        outcomes = []
+        with Connection() as conn:
+            if conn.in_transaction:
+                conn.rollback()
+            # Takes the write lock before any work, so a busy database
+            # costs a retry rather than a half-done batch
+            conn.execute("BEGIN IMMEDIATE")
+            for future, func, args in batch:
+                conn.execute("SAVEPOINT queued")
+                try:
+                    outcome = (False, func(*args))
+                except Exception as e:
+                    if busy(e):
+                        raise
+                    outcome = (True, e)
+                    conn.execute("ROLLBACK TO queued")
+                conn.execute("RELEASE queued")
+                outcomes.append(outcome)
+        return outcomes
+
+    def stats(self):
+        return {"write_commits": self.commits, "writes": self.writes,
+            "write_retries": self.retried,
+            "writes_waiting": self.pending.qsize()}
+
+
+writes = WriteQueue()
+
+
+@timed
+def save_record(table, values):
+    # Creates the file's record, or changes it if it is already recorded.
+    # Returns (created, the stored record) once it is committed.
+    created, record = writes.run(save_now, table, values)
+    changed(record)
+    return created, record
+
+
+@timed
+def update_record(table, values):
+    # The changed record, or None if there is none with the key in values
+    record = writes.run(update_now, table, values)
+    if record is not None:
+        changed(record)
+    return record
+
+
+@timed
+def delete_record(table, ref):
+    deleted = writes.run(delete_now, table, ref)
+    if deleted:
+        changed()
+    return deleted
+
+
+def changed(record=None):
+    # Only after the commit: cleared any sooner, a find on another thread
+    # could cache the old record again, and a write that is rolled back
+    # would leave its values among the completions
+    lookups.clear()
+    if record:
+        completions.learn(record)
+
+
+@timed
+def search_files(text, limit=SEARCH_LIMIT):
+    # Ranked hits from every department: (column names, rows) with the
+    # department shown by its title
+    SQL, params = search_query(text, limit)
+
+    def load():
+        with Connection() as conn:
+            cur = conn.cursor()
+            cur.execute(SQL, params)
+            rows = [(r[0], TABLES[r[1]].title) + r[2:] for r in cur.fetchall()]
+            columns = [d[0] for d in cur.description]
+            columns[0] = "REF_NO"
+            return columns, rows
+
+    columns, rows = lookups.cached(("search",) + params, load)
+    return list(columns), list(rows)
+
+
+@timed
+def file_history(ref):
+    # Every department a file has been through, oldest first, found by
+    # its original or current ref number. The last is where it is now.
+    SQL = """SELECT f.REF AS ORIGINAL_REF_NO, f.CURRENT_REF_NO,
+        m.DEPARTMENT, m.DATE, m.NEXT_DATE, m.PLACE, m.NOTE
+        FROM files f JOIN movements m ON m.FILE_ID = f.ID
+        WHERE f.REF = ? OR f.CURRENT_REF_NO = ?
+        ORDER BY m.DATE, m.ID"""
+    with Connection() as conn:
+        cur = conn.cursor()
+        cur.execute(SQL, (ref, ref))
+        rows = [r[:2] + (TABLES[r[2]].title,) + r[3:] for r in cur.fetchall()]
+        return [d[0] for d in cur.description], rows
+
+
+@timed
+def summarise(dept, group, start, end):
+    # (column names, rows) of file counts per group over the period
+    SQL, params = rollup_summary_query(dept, group, start, end) or \
+        summary_query(dept, group, start, end)
+    with Connection() as conn:
+        if missing_columns(conn, dept, group):
+            raise ValueError("%s have no %s" % (dept, group.lower()))
+        cur = conn.cursor()
+        cur.execute(SQL, params)
+        return [d[0] for d in cur.description], cur.fetchall()
+
+
+@timed
+def period_files(dept, start, end):
+    # (total, column names, rows) of dept's files over the period. The
+    # rows are read from the cursor as a view scrolls to them.
+    with Connection() as conn:
+        total = conn.execute(*period_count_query(dept, start, end)).fetchone()[0]
+    rows = RowSource(*date_range_query(dept, start, end, True))
+    return total, rows.columns, rows
+
+
+@timed
+def group_files(dept, group, value, start, end):
+    # The same for the files of one group of a summary
+    SQL, params = group_detail_query(dept, group, value, start, end, True)
+    with Connection() as conn:
+        total = conn.execute("SELECT COUNT(*) FROM (%s)" % SQL,
+            params).fetchone()[0]
+    rows = RowSource(SQL, params)
+    return total, rows.columns, rows
+
+
+def dashboard(today):
+    with Connection() as conn:
+        return dashboard_counts(conn, today)
+
+
+def rebuild_counts():
+    with Connection() as conn:
+        rebuild_rollups(conn)
+
+
+def complete(column, prefix, limit=COMPLETION_LIMIT):
+    return completions.complete(column, prefix, limit)
+
+
+def stats():
+    # Connection, cache and slow query figures for the About menu
+    figures = manager.stats()
+    figures.update(("lookup_" + k, v) for k, v in lookups.stats().items())
+    figures.update(writes.stats())
+    figures.update(slow=query_stats.slow,
+        slow_query_ms=manager.profile.get("slow_query_ms"),
+        slow_query_log=manager.profile.get("slow_query_log"))
+    return figures
+
+
+def timings():
+    return query_stats.report()
+
+
+# Rows inserted per transaction by import_csv
+IMPORT_CHUNK = 1000
+
+
+class ImportReport:
+    def __init__(self, path):
+        self.path = path
+        self.read = 0
+        self.imported = 0
+        self.rejected = []      # (line, reason, row)
+        self.seconds = 0.0
+        self.rejects_path = None
+
+    @property
+    def rate(self):
+        return self.imported / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        text = "Imported %s of %s rows in %.1f s (%.0f rows/s)" % (
+            self.imported, self.read, self.seconds, self.rate)
+        if self.rejected:
+            text += "\n%s rejected rows were written to %s" % (
+                len(self.rejected), self.rejects_path)
+        return text
+
+
+def clean_import_row(queries, row):
+    # The row's values in column order, or a ValueError saying what is wrong
+    values = []
+    for column in queries.columns:
+        value = (row.get(column) or "").strip()
+        if column.startswith("DATE_") and value:
+            value = parse_date(value).isoformat()
+        elif column == "FILE_SENT_TO" and value:
+            value = value.upper()
+            if value not in ("DPP", "RSA"):
+                raise ValueError("FILE_SENT_TO must be DPP or RSA")
+        values.append(value)
+
+    if not values[queries.columns.index(queries.key)]:
+        raise ValueError("missing %s" % queries.key)
+    return tuple(values)
+
+
+def insert_chunk(queries, chunk, report):
+    # One transaction per chunk. If any row breaks a constraint the chunk
+    # is retried row by row so only the offending rows are rejected.
+    with Connection() as conn:
+        cur = conn.cursor()
+        try:
+            for line, values, row in chunk:
+                store_record(cur, queries, values, False)
+        except sqlite3.IntegrityError:
+            conn.rollback()
+            conn.execute("BEGIN")
+            for line, values, row in chunk:
+                cur.execute("SAVEPOINT import_row")
+                try:
+                    store_record(cur, queries, values, False)
+                except sqlite3.IntegrityError as e:
+                    cur.execute("ROLLBACK TO import_row")
+                    report.rejected.append((line, str(e), row))
+                else:
+                    report.imported += 1
+                cur.execute("RELEASE import_row")
+        else:
+            report.imported += len(chunk)
+    lookups.clear()
+    # Reread on the next completion rather than added row by row
+    completions.clear()
+
+
+@timed
+def import_csv(table, path, chunk_size=IMPORT_CHUNK, progress=None,
+        report=None):
+    # Streams a CSV into a table. Headers may be the form labels or the
+    # column names. Rows that cannot be imported are written, with the
+    # reason, to <path>.rejected.csv. If the import stops part way the
+    # chunks before are kept, and report says how far it got.
+    queries = TABLES[table].queries
+    if report is None:
+        report = ImportReport(path)
+    started = time.perf_counter()
+    header = []
+
+    try:
+        with open(path, newline="", encoding="utf-8-sig") as source:
+            reader = csv.reader(source)
+            header = [column_name(h.strip()) for h in next(reader, [])]
+            if queries.key not in header:
+                raise ValueError("The CSV has no %s column" % queries.key)
+
+            chunk = []
+            for line, fields in enumerate(reader, start=2):
+                if not any(fields):
+                    continue
+                report.read += 1
+                row = dict(zip(header, fields))
+                try:
+                    chunk.append((line, clean_import_row(queries, row), fields))
+                except ValueError as e:
+                    report.rejected.append((line, str(e), fields))
+
+                if len(chunk) >= chunk_size:
+                    insert_chunk(queries, chunk, report)
+                    chunk = []
+                    report.seconds = time.perf_counter() - started
+                    if progress:
+                        progress(report)
+
+            if chunk:
+                insert_chunk(queries, chunk, report)
+    finally:
+        report.seconds = time.perf_counter() - started
+        if report.rejected:
+            report.rejects_path = os.path.splitext(path)[0] + ".rejected.csv"
+            with open(report.rejects_path, "w", newline="",
+                    encoding="utf-8") as out:
+                writer = csv.writer(out)
+                writer.writerow(["LINE", "REASON"] + header)
+                for line, reason, fields in sorted(report.rejected):
+                    writer.writerow([line, reason] + list(fields))
+    return report
+
+
+# Rows fetched from a cursor per round trip
+FETCH_BATCH = 200
+
+# Rows per fetchmany() when exporting
+EXPORT_BATCH = 2000
+
+def write_stream(out, columns, batches, as_json=False, progress=None):
+    # Writes batches of rows to an open file as CSV or JSON Lines. Only
+    # one batch is held in memory at a time.
+    count = 0
+    if as_json:
+        for rows in batches:
+            for row in rows:
+                out.write(json.dumps(dict(zip(columns, row)),
+                    ensure_ascii=False, default=str) + "\n")
+            count += len(rows)
+            if progress:
+                progress(count)
+    else:
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for rows in batches:
+            writer.writerows(rows)
+            count += len(rows)
+            if progress:
+                progress(count)
+    return count
+
+
+def write_rows(columns, batches, path, progress=None):
+    # JSON Lines when path ends in .jsonl or .json, otherwise CSV
+    as_json = path.lower().endswith((".jsonl", ".json"))
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        return write_stream(out, columns, batches, as_json, progress)
+
+
+@timed
+def stream_query(sql, params, out, as_json=False, progress=None,
+        batch=EXPORT_BATCH):
+    with Connection() as conn:
+        cur = conn.cursor()
+        cur.execute(sql, params)
+        columns = [d[0] for d in cur.description]
+        batches = iter(lambda: cur.fetchmany(batch), [])
+        return write_stream(out, columns, batches, as_json, progress)
+
+
+def export_query(sql, params, path, progress=None, batch=EXPORT_BATCH):
+    as_json = path.lower().endswith((".jsonl", ".json"))
+    with open(path, "w", newline="", encoding="utf-8") as out:
+        return stream_query(sql, params, out, as_json, progress, batch)
+
+
+class RowSource:
+    # The rows of a query, fetched from its cursor a batch at a time as
+    # a view scrolls towards them. The cursor has a connection of its own
+    # so it does not hold up the thread's shared connection. While it is
+    # open it holds a read snapshot, which in WAL mode keeps the WAL from
+    # being reset, so a view that stops scrolling should pause() it.
+    # The query's last column must be ROW_KEY, a unique key that is not
+    # shown: rows come in order of it, after any sort column, so a read
+    # that was paused seeks on from the last row it read. after starts
+    # the read past that (sort value, ROW_KEY) pair.
+    def __init__(self, sql, params=(), batch=FETCH_BATCH, column=None,
+            descending=False, after=None):
+        self.sql = sql
+        self.params = tuple(params)
+        self.batch = batch
+        self.column = column
+        self.descending = descending
+        self.rows = []
+        self.after = tuple(after) if after else None
+        self.exhausted = False
+        self.cursor = None
+
+        direction = " DESC" if descending else ""
+        self.order = "ROW_KEY" + direction
+        if column:
+            self.order = '"%s"%s, %s' % (column, direction, self.order)
+
+        self.open()
+        self.columns = [d[0] for d in self.cursor.description][:-1]
+        self.sort = self.columns.index(column) if column else None
+        self.fetch(batch)
+
+    def resume(self):
+        # The query and its parameters, seeking past the last row read
+        SQL = "SELECT * FROM (%s)" % self.sql
+        if self.after is None:
+            return SQL + " ORDER BY " + self.order, self.params
+
+        value, key = self.after
+        beyond = "<" if self.descending else ">"
+        column = '"%s"' % self.column
+        if self.column is None:
+            where, params = "ROW_KEY > ?", (key,)
+        elif value is None:
+            # Nulls sort first, or last when descending
+            where, params = "%s IS NULL AND ROW_KEY %s ?" % (column, beyond), \
+                (key,)
+            if not self.descending:
+                where = "(%s) OR %s IS NOT NULL" % (where, column)
+        else:
+            where = "%s %s ? OR (%s = ? AND ROW_KEY %s ?)" % (
+                column, beyond, column, beyond)
+            params = (value, value, key)
+            if self.descending:
+                where += " OR %s IS NULL" % column
+        return "%s WHERE %s ORDER BY %s" % (SQL, where, self.order), \
+            self.params + params
+
+    def open(self):
+        # Runs the query again, from the first row not read yet
+        self.conn = manager.reader()
+        job = getattr(manager.local, "job", None)
+        if job:
+            job.watch(self.conn)
+        try:
+            self.cursor = self.conn.cursor()
+            self.cursor.execute(*self.resume())
+        except Exception:
+            self.cursor = None
+            manager.release(self.conn)
+            raise
+
+    def fetch(self, count):
+        # Make sure at least count rows are loaded, if the query has them
+        while not self.exhausted and len(self.rows) < count:
+            if self.cursor is None:
+                self.open()
+            rows = self.cursor.fetchmany(self.batch)
+            if rows:
+                last = rows[-1]
+                self.after = (None if self.sort is None else last[self.sort],
+                    last[-1])
+                self.rows.extend(row[:-1] for row in rows)
+            if len(rows) < self.batch:
+                self.close()
+
+    def pause(self):
+        # Ends the read until more rows are wanted
+        if self.cursor is not None:
+            self.cursor.close()
+            self.cursor = None
+            manager.put_back(self.conn)
+
+    def close(self):
+        if not self.exhausted:
+            self.exhausted = True
+            self.pause()
+
+    def export(self, path, progress=None):
+        # Re-runs the query rather than writing the rows scrolled so far
+        SQL = "SELECT %s FROM (%s) ORDER BY %s" % (
+            ", ".join('"%s"' % c for c in self.columns), self.sql, self.order)
+        return export_query(SQL, self.params, path, progress)
+
+    def sorted(self, column, descending=False):
+        # The same query re-run in a new order
+        return RowSource(self.sql, self.params, self.batch, column, descending)
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, index):
+        return self.rows[index]
+
+
+# Files shown per page when browsing a department
+PAGE_SIZE = 100
+
+class Pager:
+    # A department a page at a time, in ref number or date order. Each
+    # page seeks from the sort key of the last row shown instead of
+    # counting past an offset, so every page costs the same however far
+    # into the department it is. Rows without a sort value come first.
+    ORDERS = ("REF NO", "DATE")
+
+    def __init__(self, table, order="REF NO", size=PAGE_SIZE):
+        queries = TABLES[table].queries
+        self.table = table
+        self.order = order
+        self.size = size
+        self.columns = list(queries.columns)
+        if order == "DATE":
+            self.key, self.tie = "m.DATE", "m.ID"
+            joined = "movements m CROSS JOIN files f ON f.ID = m.FILE_ID"
+        else:
+            self.key, self.tie = "f.%s" % queries.file_key, "f.ID"
+            joined = "files f CROSS JOIN movements m ON m.FILE_ID = f.ID"
+        self.source = queries.source
+        self.where = "FROM %s WHERE m.DEPARTMENT = '%s'" % (joined, table)
+        self.rows = []
+        self.start = 0
+        self.total = 0
+
+    @timed
+    def fetch(self, segments, descending=False):
+        # segments are (condition, params) read in turn until the page
+        # is full
+        order = " DESC" if descending else ""
+        SQL = "SELECT %s, %s, %s %s AND %%s ORDER BY %s%s, %s%s LIMIT ?" % (
+            self.source, self.key, self.tie, self.where, self.key, order,
+            self.tie, order)
+        rows = []
+        with Connection() as conn:
+            for condition, params in segments:
+                if len(rows) >= self.size:
+                    break
+                rows += conn.execute(SQL % condition,
+                    params + (self.size - len(rows),)).fetchall()
+            self.total = conn.execute("SELECT COALESCE(SUM(FILES), 0)"
+                " FROM file_counts WHERE DEPARTMENT = ?",
+                (self.table,)).fetchone()[0]
+        if descending:
+            rows.reverse()
+        return rows
+
+    def first(self):
+        self.rows = self.fetch([("%s IS NULL" % self.key, ()),
+            ("%s IS NOT NULL" % self.key, ())])
+        self.start = 0
+        return True
+
+    def last(self):
+        self.rows = self.fetch([("%s IS NOT NULL" % self.key, ()),
+            ("%s IS NULL" % self.key, ())], True)
+        self.start = max(self.total - len(self.rows), 0)
+        return True
+
+    def next(self):
+        if not self.rows:
+            return self.first()
+        value, id = self.rows[-1][-2:]
+        if value is None:
+            segments = [("%s IS NULL AND %s > ?" % (self.key, self.tie), (id,)),
+                ("%s IS NOT NULL" % self.key, ())]
+        else:
+            segments = [("(%s, %s) > (?, ?)" % (self.key, self.tie),
+                (value, id))]
+        rows = self.fetch(segments)
+        if not rows:
+            return False
+        self.start += len(self.rows)
+        self.rows = rows
+        return True
+
+    def previous(self):
+        if not self.rows:
+            return self.first()
+        value, id = self.rows[0][-2:]
+        if value is None:
+            segments = [("%s IS NULL AND %s < ?" % (self.key, self.tie), (id,))]
+        else:
+            segments = [("(%s, %s) < (?, ?)" % (self.key, self.tie),
+                (value, id)), ("%s IS NULL" % self.key, ())]
+        rows = self.fetch(segments, True)
+        if not rows:
+            return False
+        if len(rows) < self.size:
+            # Back at the beginning; show a full first page
+            return self.first()
+        self.start = max(self.start - len(rows), 0)
+        self.rows = rows
+        return True
+
+    @property
+    def page(self):
+        # The rows without their sort keys
+        return [row[:-2] for row in self.rows]
+
+    def span(self):
+        if not self.rows:
+            return 0, 0, self.total
+        return self.start + 1, self.start + len(self.rows), self.total
+
+    def export(self, path, progress=None):
+        # Every file of the department in the order being browsed
+        SQL = "SELECT %s %s ORDER BY %s, %s" % (self.source, self.where,
+            self.key, self.tie)
+        return export_query(SQL, (), path, progress)
+
+
+def sort_key(value):
+    # Numbers by value before text, text without regard to case and
+    # blanks last. ISO dates sort correctly as text.
+    if value is None or value == "":
+        return (2, 0, "")
+    try:
+        return (0, float(value), "")
+    except (TypeError, ValueError):
+        return (1, 0, str(value).lower())
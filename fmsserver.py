@@ -0,0 +1,452 @@
+"""Serves one FMS database to the windows on many workstations.
+
+    python FMS.py serve --host 0.0.0.0 --port 8470
+    FMS_SERVER=http://records-pc:8470 python FMS.py
+
+The server owns the database file; the windows send it HTTP requests
+with JSON bodies instead of opening the file over a network share.
+Reads run side by side on a pool of threads, each with its own
+connection. Writes go through fmsdb's write queue, which commits
+whatever saves arrive together in one transaction, so clients never
+wait on each other's file locks.
+
+A request is POST /api/<operation> with {"args": [...]}. The reply is
+{"result": ...}, or {"error": message, "type": exception name} with a
+4xx or 5xx status. There is no authentication, so only serve on a
+network where every machine may read and change the files.
+"""
+
+import asyncio
+import functools
+import http.client
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.parse import urlsplit
+
+import fmsdb
+
+DEFAULT_PORT = 8470
+
+# Threads answering reads at the same time
+READERS = 4
+
+# Requests waiting on the write queue at the same time; the more there
+# are, the more each commit can carry
+WRITERS = 16
+
+# Largest request body accepted, in bytes
+MAX_REQUEST = 1024 * 1024
+
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found",
+    409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error",
+    503: "Service Unavailable"}
+
+
+def day(text):
+    return date.fromisoformat(text)
+
+
+def read_args(readers, args):
+    # Arguments as sent, converted by readers where one is given
+    return [read(arg) if read and arg is not None else arg
+        for read, arg in zip(list(readers) + [None] * len(args), args)]
+
+
+def first_rows(func):
+    # The first batch of rows and where it ends. A cursor cannot stay
+    # open between requests, so the client asks for more with "rows".
+    @functools.wraps(func)
+    def read(*args):
+        total, columns, rows = func(*args)
+        rows.pause()
+        return {"total": total, "columns": columns, "rows": rows.rows,
+            "after": rows.after, "exhausted": rows.exhausted}
+    return read
+
+
+# Queries read a batch at a time: (query, how to read each argument)
+ROW_QUERIES = {
+    "period_files": (functools.partial(fmsdb.date_range_query, keyed=True),
+        (None, day, day)),
+    "group_files": (functools.partial(fmsdb.group_detail_query, keyed=True),
+        (None, None, None, day, day)),
+}
+
+
+def rows(name, args, column, descending, after, count):
+    # Up to count rows of a query, in order of column, from after on
+    query, readers = ROW_QUERIES[name]
+    SQL, params = query(*read_args(readers, args))
+    source = fmsdb.RowSource(SQL, params, min(count, fmsdb.EXPORT_BATCH),
+        column, descending, after)
+    source.pause()
+    return {"rows": source.rows, "after": source.after,
+        "exhausted": source.exhausted}
+
+
+def page(table, order, size, step, rows, start):
+    # Moves a Pager on from the rows the client is showing
+    if step not in ("first", "next", "previous", "last"):
+        raise ValueError("No such page: %s" % step)
+    pager = fmsdb.Pager(table, order, size)
+    pager.rows = [tuple(row) for row in rows]
+    pager.start = start
+    moved = getattr(pager, step)()
+    return {"moved": moved, "rows": pager.rows, "start": pager.start,
+        "total": pager.total}
+
+
+# name: (function, whether it writes, how to read each argument; None
+# leaves it as sent)
+OPERATIONS = {
+    "find_record": (fmsdb.find_record, False, ()),
+    "search_files": (fmsdb.search_files, False, ()),
+    "file_history": (fmsdb.file_history, False, ()),
+    "complete": (fmsdb.complete, False, ()),
+    "summarise": (fmsdb.summarise, False, (None, None, day, day)),
+    "period_files": (first_rows(fmsdb.period_files), False, (None, day, day)),
+    "group_files": (first_rows(fmsdb.group_files), False,
+        (None, None, None, day, day)),
+    "rows": (rows, False, ()),
+    "dashboard": (fmsdb.dashboard, False, (day,)),
+    "page": (page, False, ()),
+    "stats": (fmsdb.stats, False, ()),
+    "timings": (fmsdb.timings, False, ()),
+    "save_record": (fmsdb.save_record, True, ()),
+    "update_record": (fmsdb.update_record, True, ()),
+    "delete_record": (fmsdb.delete_record, True, ()),
+    "rebuild_counts": (fmsdb.rebuild_counts, True, ()),
+}
+
+
+class Server:
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, readers=READERS):
+        self.host = host
+        self.port = port
+        self.readers = ThreadPoolExecutor(readers,
+            thread_name_prefix="fms-read")
+        self.writer = ThreadPoolExecutor(WRITERS,
+            thread_name_prefix="fms-write")
+
+    async def serve(self, ready=None):
+        server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = server.sockets[0].getsockname()[1]
+        if ready:
+            ready(self)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        self.readers.shutdown()
+        self.writer.shutdown()
+        fmsdb.manager.close()
+
+    async def handle(self, reader, writer):
+        # One connection, kept open for as many requests as the client sends
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                method, target, version = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > MAX_REQUEST:
+                    await self.respond(writer, 413,
+                        {"error": "Request too large", "type": "ValueError"})
+                    break
+                body = await reader.readexactly(length) if length else b""
+
+                status, reply = await self.dispatch(method, target, body)
+                keep_alive = version == "HTTP/1.1" and \
+                    headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, reply, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, writer, status, reply, keep_alive=False):
+        body = json.dumps(reply, default=str).encode("utf-8")
+        writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\n"
+            "Content-Length: %d\r\nConnection: %s\r\n\r\n" % (status,
+            REASONS[status], len(body),
+            "keep-alive" if keep_alive else "close")).encode("latin-1") + body)
+        await writer.drain()
+
+    async def dispatch(self, method, target, body):
+        if method == "GET" and target == "/":
+            return 200, {"result": {"server": "fms",
+                "operations": sorted(OPERATIONS)}}
+        name = target[len("/api/"):] if target.startswith("/api/") else None
+        if method != "POST" or name not in OPERATIONS:
+            return 404, {"error": "No such operation: %s %s" % (method, target),
+                "type": "ValueError"}
+
+        func, writes, readers = OPERATIONS[name]
+        try:
+            args = read_args(readers, json.loads(body or b"{}").get("args", []))
+        except (ValueError, AttributeError, TypeError) as e:
+            return 400, {"error": "Bad request: %s" % e, "type": "ValueError"}
+
+        loop = asyncio.get_running_loop()
+        try:
+            result = await loop.run_in_executor(
+                self.writer if writes else self.readers,
+                functools.partial(func, *args))
+        except sqlite3.IntegrityError as e:
+            return 409, {"error": str(e), "type": "IntegrityError"}
+        except sqlite3.OperationalError as e:
+            return 503, {"error": str(e), "type": "OperationalError"}
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": str(e), "type": "ValueError"}
+        except Exception as e:
+            return 500, {"error": str(e), "type": type(e).__name__}
+        return 200, {"result": result}
+
+
+def serve(host="127.0.0.1", port=DEFAULT_PORT, readers=READERS):
+    fmsdb.migrate()
+    server = Server(host, port, readers)
+
+    def ready(server):
+        print("FMS server for %s on http://%s:%s" % (fmsdb.manager.database,
+            server.host, server.port), flush=True)
+
+    try:
+        asyncio.run(server.serve(ready))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+
+
+def rows_in(result):
+    # Rows a reply carries, for the timings
+    if isinstance(result, dict):
+        return len(result["rows"]) if "rows" in result else 1
+    if isinstance(result, list) and result and isinstance(result[-1], list):
+        return len(result[-1])
+    return 0
+
+
+class Client:
+    # Stands in for fmsdb in the window: the same functions, answered by
+    # a server. Each thread keeps its own connection to it.
+    ERRORS = {"ValueError": ValueError,
+        "IntegrityError": sqlite3.IntegrityError,
+        "OperationalError": sqlite3.OperationalError}
+
+    def __init__(self, url, timeout=60):
+        parts = urlsplit(url if "://" in url else "http://" + url)
+        self.host = parts.hostname
+        self.port = parts.port or DEFAULT_PORT
+        self.timeout = timeout
+        self.local = threading.local()
+
+    def __repr__(self):
+        return "http://%s:%s" % (self.host, self.port)
+
+    def call(self, name, *args):
+        body = json.dumps({"args": args}, default=str)
+        started = time.perf_counter()
+        while True:
+            conn = getattr(self.local, "conn", None)
+            reused = conn is not None
+            if not reused:
+                conn = self.local.conn = http.client.HTTPConnection(
+                    self.host, self.port, timeout=self.timeout)
+            try:
+                conn.request("POST", "/api/" + name, body,
+                    {"Content-Type": "application/json"})
+                response = conn.getresponse()
+                reply = json.loads(response.read())
+                break
+            except (OSError, http.client.HTTPException) as e:
+                conn.close()
+                self.local.conn = None
+                # A write is never sent twice: it may have been saved
+                # before its answer was lost
+                if OPERATIONS[name][1]:
+                    raise ConnectionError("No answer from the FMS server at"
+                        " %r; the change may not have been saved: %s" % (
+                        self, e))
+                # The server may have closed a connection left idle
+                if not reused:
+                    raise ConnectionError("No answer from the FMS server at"
+                        " %r: %s" % (self, e))
+
+        if "error" in reply:
+            raise self.ERRORS.get(reply["type"], RuntimeError)(reply["error"])
+        result = reply["result"]
+        # Shown as query time on the status bars; there is no plan to log
+        fmsdb.query_stats.statement(None, "POST /api/" + name, args,
+            time.perf_counter() - started, rows_in(result))
+        return result
+
+    def find_record(self, table, ref):
+        return self.call("find_record", table, ref)
+
+    def save_record(self, table, values):
+        created, record = self.call("save_record", table, values)
+        return created, record
+
+    def update_record(self, table, values):
+        return self.call("update_record", table, values)
+
+    def delete_record(self, table, ref):
+        return self.call("delete_record", table, ref)
+
+    def search_files(self, text, limit=fmsdb.SEARCH_LIMIT):
+        columns, rows = self.call("search_files", text, limit)
+        return columns, [tuple(row) for row in rows]
+
+    def file_history(self, ref):
+        columns, rows = self.call("file_history", ref)
+        return columns, [tuple(row) for row in rows]
+
+    def complete(self, column, prefix, limit=fmsdb.COMPLETION_LIMIT):
+        return self.call("complete", column, prefix, limit)
+
+    def summarise(self, dept, group, start, end):
+        columns, rows = self.call("summarise", dept, group, start, end)
+        return columns, [tuple(row) for row in rows]
+
+    def row_source(self, name, *args):
+        reply = self.call(name, *args)
+        return reply["total"], reply["columns"], RemoteRowSource(self, name,
+            args, reply["columns"], reply)
+
+    def period_files(self, dept, start, end):
+        return self.row_source("period_files", dept, start, end)
+
+    def group_files(self, dept, group, value, start, end):
+        return self.row_source("group_files", dept, group, value, start, end)
+
+    def dashboard(self, today):
+        return [tuple(row) for row in self.call("dashboard", today)]
+
+    def rebuild_counts(self):
+        return self.call("rebuild_counts")
+
+    def stats(self):
+        return self.call("stats")
+
+    def timings(self):
+        return self.call("timings")
+
+    def Pager(self, table, order="REF NO", size=fmsdb.PAGE_SIZE):
+        return RemotePager(self, table, order, size)
+
+    def import_csv(self, table, path, chunk_size=None, progress=None,
+            report=None):
+        raise ValueError("Files are imported on the server:"
+            " python FMS.py import %s FILE" % table)
+
+
+class RemoteRowSource(fmsdb.RowSource):
+    # A RowSource whose batches are read by the server. Nothing is held
+    # open between them, so pausing costs nothing.
+    def __init__(self, client, name, args, columns, reply,
+            batch=fmsdb.FETCH_BATCH, column=None, descending=False):
+        self.client = client
+        self.name = name
+        self.args = args
+        self.columns = columns
+        self.batch = batch
+        self.column = column
+        self.descending = descending
+        self.rows = []
+        self.cursor = None
+        self.receive(reply)
+
+    def receive(self, reply):
+        self.rows.extend(tuple(row) for row in reply["rows"])
+        self.after = reply["after"]
+        self.exhausted = reply["exhausted"]
+
+    def read(self, after, count):
+        return self.client.call("rows", self.name, self.args, self.column,
+            self.descending, after, count)
+
+    def fetch(self, count):
+        while not self.exhausted and len(self.rows) < count:
+            self.receive(self.read(self.after, self.batch))
+
+    def pause(self):
+        pass
+
+    def close(self):
+        self.exhausted = True
+
+    def export(self, path, progress=None):
+        # Large batches, for fewer round trips
+        def batches():
+            reply = self.read(None, fmsdb.EXPORT_BATCH)
+            while reply["rows"]:
+                yield reply["rows"]
+                if reply["exhausted"]:
+                    break
+                reply = self.read(reply["after"], fmsdb.EXPORT_BATCH)
+
+        return fmsdb.write_rows(self.columns, batches(), path, progress)
+
+    def sorted(self, column, descending=False):
+        reply = self.client.call("rows", self.name, self.args, column,
+            descending, None, self.batch)
+        return RemoteRowSource(self.client, self.name, self.args,
+            self.columns, reply, self.batch, column, descending)
+
+
+class RemotePager(fmsdb.Pager):
+    # A Pager whose pages are read by the server
+    def __init__(self, client, table, order="REF NO", size=fmsdb.PAGE_SIZE):
+        super().__init__(table, order, size)
+        self.client = client
+
+    def move(self, step):
+        reply = self.client.call("page", self.table, self.order, self.size,
+            step, self.rows, self.start)
+        if reply["moved"]:
+            self.rows = [tuple(row) for row in reply["rows"]]
+            self.start = reply["start"]
+        self.total = reply["total"]
+        return reply["moved"]
+
+    def first(self):
+        return self.move("first")
+
+    def last(self):
+        return self.move("last")
+
+    def next(self):
+        return self.move("next")
+
+    def previous(self):
+        return self.move("previous")
+
+    def export(self, path, progress=None):
+        # Large pages, for fewer round trips
+        pager = RemotePager(self.client, self.table, self.order,
+            fmsdb.EXPORT_BATCH)
+
+        def pages():
+            moved = pager.first()
+            while moved and pager.rows:
+                yield pager.page
+                moved = pager.next()
+
+        return fmsdb.write_rows(self.columns, pages(), path, progress)
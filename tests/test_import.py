@@ -0,0 +1,46 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import fmsdb
+
+
+class ImportTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"))
+        fmsdb.migrate()
+        self.path = os.path.join(self.dir, "allocation.csv")
+        with open(self.path, "w", newline="") as out:
+            writer = csv.writer(out)
+            writer.writerow(["Original REF NO", "Current REF NO",
+                "Complainant", "Date of Allocation"])
+            for i in range(10):
+                writer.writerow(["GEF %d/2016" % i, "", "Alice",
+                    "not a date" if i == 1 else "2017-01-0%d" % (i % 9 + 1)])
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def test_stopped_import_keeps_its_report(self):
+        report = fmsdb.ImportReport(self.path)
+
+        def progress(report):
+            raise KeyboardInterrupt
+
+        with self.assertRaises(KeyboardInterrupt):
+            fmsdb.import_csv("allocation", self.path, 4, progress, report)
+
+        # The first chunk is committed and the rejects so far are written
+        self.assertEqual(report.imported, 4)
+        self.assertEqual(report.read, 5)
+        self.assertTrue(os.path.exists(report.rejects_path))
+        self.assertIsNotNone(fmsdb.find_record("allocation", "GEF 0/2016"))
+        self.assertIsNone(fmsdb.find_record("allocation", "GEF 9/2016"))
+
+
+if __name__ == "__main__":
+    unittest.main()
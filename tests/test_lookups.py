@@ -0,0 +1,74 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+import fmsdb
+
+
+class LookupCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "fms.db")
+        fmsdb.manager.configure(self.path)
+        fmsdb.migrate()
+        fmsdb.save_record("putaway", ("GEF 1/2016", "", "Alice", "Ben",
+            "Theft", "Shelf 1", "Open", "2017-03-04"))
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def complainant(self):
+        return fmsdb.find_record("putaway", "GEF 1/2016")["COMPLAINANT"]
+
+    def test_repeated_finds_are_cached(self):
+        self.complainant()
+        hits = fmsdb.lookups.hits
+        self.assertEqual(self.complainant(), "Alice")
+        self.assertEqual(fmsdb.lookups.hits, hits + 1)
+
+    def test_a_commit_by_another_process_is_seen(self):
+        self.complainant()
+        other = sqlite3.connect(self.path)
+        with other:
+            other.execute("UPDATE files SET COMPLAINANT = 'Alicia'")
+        other.close()
+        self.assertEqual(self.complainant(), "Alicia")
+
+    def test_a_commit_by_another_thread_is_seen(self):
+        self.complainant()
+
+        def change():
+            with fmsdb.Connection() as conn:
+                conn.execute("UPDATE files SET COMPLAINANT = 'Alicia'")
+
+        thread = threading.Thread(target=change)
+        thread.start()
+        thread.join()
+        self.assertEqual(self.complainant(), "Alicia")
+
+    def test_saves_are_seen_and_completed(self):
+        self.complainant()
+        fmsdb.complete("COMPLAINANT", "A")
+        fmsdb.update_record("putaway", ("GEF 1/2016", "", "Alicia", "Ben",
+            "Theft", "Shelf 1", "Open", "2017-03-04"))
+        self.assertEqual(self.complainant(), "Alicia")
+        self.assertEqual(fmsdb.complete("COMPLAINANT", "Ali"),
+            ["Alice", "Alicia"])
+
+    def test_a_refused_save_is_not_completed(self):
+        fmsdb.complete("COMPLAINANT", "A")
+        fmsdb.save_record("files_sent_to_dpp", ("GEF 2/2016", "CRB 1/2017",
+            "Alice", "Bob", "Theft", "Carol", "2017-01-02", "", "DPP", ""))
+        with self.assertRaises(sqlite3.IntegrityError):
+            fmsdb.save_record("files_sent_to_dpp", ("GEF 3/2016",
+                "CRB 1/2017", "Zelda", "Bob", "Theft", "Carol", "2017-01-02",
+                "", "DPP", ""))
+        self.assertEqual(fmsdb.complete("COMPLAINANT", "Z"), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
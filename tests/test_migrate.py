@@ -0,0 +1,114 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import fmsdb
+
+
+def baseline_database(path, rows):
+    # A database as FMS kept it before versioned migrations: one table
+    # per department, each repeating the file's details
+    conn = sqlite3.connect(path)
+    for table in fmsdb.TABLES.values():
+        conn.execute(table.schema)
+    for name, values in rows:
+        conn.execute("INSERT INTO %s VALUES (%s)" % (
+            name, ", ".join("?" * len(values))), values)
+    conn.commit()
+    conn.close()
+
+
+class MigrateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "fms.db")
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def migrate(self, rows):
+        baseline_database(self.path, rows)
+        fmsdb.manager.configure(self.path)
+        return fmsdb.migrate()
+
+    def tables(self):
+        return [name for (name,) in self.select("SELECT name FROM"
+            " sqlite_master WHERE type = 'table' AND name LIKE '%legacy'"
+            " ORDER BY name")]
+
+    def select(self, sql, params=()):
+        with fmsdb.Connection() as conn:
+            return conn.execute(sql, params).fetchall()
+
+    def test_divergent_rows_are_kept(self):
+        dpp = ("X", "X1", "Alice", "Bob", "Theft", "Carol", "2017-01-02",
+            "2017-02-03", "DPP", "")
+        putaway = ("X", "X2", "Alicia", "Bob", "Robbery", "Shelf 4",
+            "Closed", "2017-03-04")
+        conflicts = self.migrate([("files_sent_to_dpp", dpp),
+            ("putaway", putaway)])
+        self.assertEqual(conflicts, ["putaway X"])
+        self.assertEqual(self.tables(),
+            ["files_sent_to_dpp_legacy", "putaway_legacy"])
+
+        # The departments now share one record of the file
+        self.assertEqual(self.select("SELECT CURRENT_REF_NO, COMPLAINANT,"
+            " OFFENCE FROM files_sent_to_dpp"), [("X2", "Alicia", "Robbery")])
+        self.assertEqual(self.select("SELECT * FROM putaway"), [putaway])
+
+        # and the rows they replaced are still there
+        self.assertEqual(self.select("SELECT * FROM files_sent_to_dpp_legacy"),
+            [dpp])
+        self.assertEqual(self.select("SELECT * FROM putaway_legacy"),
+            [putaway])
+
+    def test_agreeing_rows_are_merged_quietly(self):
+        dpp = ("Y", "Y1", "Dan", "Eve", "Theft", "Carol", "2017-01-02",
+            "", "RSA", "")
+        allocation = ("Y", "Y1", "Dan", "", "Theft", "Carol", "2017-01-01")
+        court = ("Y1", "Dan", "Eve", "Theft", "Carol", "2017-05-06",
+            "2017-06-07", "Hearing")
+        conflicts = self.migrate([("files_sent_to_dpp", dpp),
+            ("allocation", allocation), ("court_going", court)])
+        self.assertEqual(conflicts, [])
+        with fmsdb.Connection() as conn:
+            self.assertEqual(fmsdb.schema_version(conn),
+                len(fmsdb.MIGRATIONS))
+
+        self.assertEqual(self.select("SELECT COUNT(*) FROM files"), [(1,)])
+        self.assertEqual(self.select("SELECT * FROM files_sent_to_dpp"), [dpp])
+        self.assertEqual(self.select("SELECT * FROM court_going"), [court])
+        # A blank detail does not overwrite what another department knew
+        self.assertEqual(self.select("SELECT SUSPECT FROM allocation"),
+            [("Eve",)])
+
+    def test_shared_current_ref_stays_in_legacy(self):
+        dpp = ("A", "C1", "Alice", "Bob", "Theft", "Carol", "2017-01-02",
+            "", "DPP", "")
+        putaway = ("B", "C1", "Dan", "Eve", "Theft", "Shelf 4", "Closed",
+            "2017-03-04")
+        conflicts = self.migrate([("files_sent_to_dpp", dpp),
+            ("putaway", putaway)])
+        self.assertEqual(len(conflicts), 1)
+        self.assertIn("putaway B (not moved", conflicts[0])
+        self.assertEqual(self.select("SELECT * FROM putaway"), [])
+        self.assertEqual(self.select("SELECT * FROM putaway_legacy"),
+            [putaway])
+
+    def test_views_keep_the_department_columns(self):
+        self.assertEqual(self.migrate([]), [])
+        # An empty department leaves nothing behind
+        self.assertEqual(self.tables(), [])
+        self.assertEqual(fmsdb.migrate(), [])
+        for table in fmsdb.TABLES.values():
+            with fmsdb.Connection() as conn:
+                columns = [r[1] for r in conn.execute(
+                    "PRAGMA table_info(%s)" % table.name)]
+            self.assertEqual(columns, table.queries.columns)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import fmsdb
+
+
+class PagerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"))
+        fmsdb.migrate()
+        for n, day in enumerate([5, 3, 9, 3, 1, 7, 3, 8, 2, 6, 4]):
+            fmsdb.save_record("putaway", ("GEF %d/2016" % n, "", "Alice",
+                "Ben", "Theft", "Shelf 1", "Open", "2017-03-%02d" % day))
+        # Dates the migration could not read are left empty
+        with fmsdb.Connection() as conn:
+            conn.execute("UPDATE movements SET DATE = NULL WHERE FILE_ID IN"
+                " (SELECT ID FROM files WHERE REF IN ('GEF 2/2016',"
+                " 'GEF 7/2016', 'GEF 10/2016'))")
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def expected(self, order):
+        pager = fmsdb.Pager("putaway", order, 100)
+        pager.first()
+        return pager.rows
+
+    def test_pages_in_order(self):
+        for order in fmsdb.Pager.ORDERS:
+            expected = self.expected(order)
+            keys = [(row[-2] is not None, row[-2] or "", row[-1])
+                for row in expected]
+            self.assertEqual(keys, sorted(keys))
+            self.assertEqual(len(expected), 11)
+
+            pager = fmsdb.Pager("putaway", order, 3)
+            pager.first()
+            rows, spans = list(pager.rows), [pager.span()]
+            while pager.next():
+                rows += pager.rows
+                spans.append(pager.span())
+            self.assertEqual(rows, expected)
+            self.assertEqual(spans[-1], (10, 11, 11))
+            self.assertFalse(pager.next())
+
+    def test_pages_back_from_the_last(self):
+        for order in fmsdb.Pager.ORDERS:
+            expected = self.expected(order)
+            pager = fmsdb.Pager("putaway", order, 3)
+            pager.last()
+            self.assertEqual(pager.rows, expected[-3:])
+            self.assertEqual(pager.span(), (9, 11, 11))
+
+            pages = 1
+            while pager.start > 0:
+                self.assertTrue(pager.previous())
+                self.assertEqual(pager.rows,
+                    expected[pager.start:pager.start + len(pager.rows)])
+                pages += 1
+            # The first page is shown full, overlapping the one after it
+            self.assertEqual(pager.rows, expected[:3])
+            self.assertEqual(pager.span(), (1, 3, 11))
+            self.assertEqual(pages, 4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,104 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+import fmsdb
+
+
+def dpp(original, current, complainant="Alice"):
+    return (original, current, complainant, "Bob", "Theft", "Carol",
+        "2017-01-02", "", "DPP", "")
+
+
+class CurrentRefTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"))
+        fmsdb.migrate()
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def test_save_refuses_a_current_ref_in_use(self):
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 5/2016", "CRB 1/2017"))
+        with self.assertRaises(sqlite3.IntegrityError):
+            fmsdb.save_record("files_sent_to_dpp",
+                dpp("GEF 6/2016", "CRB 1/2017"))
+        self.assertIsNone(fmsdb.find_record("files_sent_to_dpp", "GEF 6/2016"))
+
+        # The file itself may be saved again with its own number
+        created, record = fmsdb.save_record("files_sent_to_dpp",
+            dpp("GEF 5/2016", "CRB 1/2017", "Alicia"))
+        self.assertFalse(created)
+        self.assertEqual(record["COMPLAINANT"], "Alicia")
+
+    def test_update_refuses_a_current_ref_in_use(self):
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 5/2016", "CRB 1/2017"))
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 6/2016", "CRB 2/2017"))
+        with self.assertRaises(sqlite3.IntegrityError):
+            fmsdb.update_record("files_sent_to_dpp",
+                dpp("GEF 6/2016", "CRB 1/2017"))
+        self.assertEqual(fmsdb.find_record("files_sent_to_dpp",
+            "GEF 6/2016")["CURRENT_REF_NO"], "CRB 2/2017")
+
+    def test_update_can_clear_a_detail(self):
+        fmsdb.save_record("putaway", ("GEF 7/2016", "", "Alice", "Ben",
+            "Theft", "Shelf 1", "Open", "2017-03-04"))
+        record = fmsdb.update_record("putaway", ("GEF 7/2016", "", "Alice",
+            "", "Theft", "Shelf 1", "Open", "2017-03-04"))
+        self.assertEqual(record["SUSPECT"], "")
+
+        # A save with the detail blank keeps what was recorded
+        fmsdb.update_record("putaway", ("GEF 7/2016", "", "Alice", "Ben",
+            "Theft", "Shelf 1", "Open", "2017-03-04"))
+        created, record = fmsdb.save_record("allocation", ("GEF 7/2016", "",
+            "Alice", "", "Theft", "Carol", "2017-01-01"))
+        self.assertEqual(record["SUSPECT"], "Ben")
+
+    def test_blank_current_refs_are_not_shared(self):
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 5/2016", ""))
+        created, record = fmsdb.save_record("files_sent_to_dpp",
+            dpp("GEF 6/2016", ""))
+        self.assertTrue(created)
+
+    def test_court_going_joins_the_file_with_the_current_ref(self):
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 5/2016", "CRB 1/2017"))
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 6/2016", "CRB 2/2017",
+            "Dan"))
+        fmsdb.save_record("court_going", ("CRB 2/2017", "", "", "", "",
+            "2017-05-06", "2017-06-07", "Hearing"))
+        self.assertEqual(fmsdb.find_record("court_going",
+            "CRB 2/2017")["COMPLAINANT"], "Dan")
+        self.assertTrue(fmsdb.delete_record("court_going", "CRB 2/2017"))
+        self.assertIsNotNone(fmsdb.find_record("files_sent_to_dpp",
+            "GEF 6/2016"))
+
+    def test_court_going_first_then_the_original_ref(self):
+        fmsdb.save_record("court_going", ("CRB 9/2017", "Dan", "", "", "",
+            "2017-05-06", "2017-06-07", "Hearing"))
+        created, record = fmsdb.save_record("files_sent_to_dpp",
+            dpp("GEF 1/2016", "CRB 9/2017", ""))
+        self.assertTrue(created)
+        self.assertEqual(record["COMPLAINANT"], "Dan")
+        self.assertEqual(fmsdb.find_record("court_going",
+            "CRB 9/2017")["SUSPECT"], "Bob")
+        with fmsdb.Connection() as conn:
+            self.assertEqual(conn.execute("SELECT REF FROM files").fetchall(),
+                [("GEF 1/2016",)])
+
+        # A file already known by its original ref takes court going's in
+        fmsdb.save_record("allocation", ("GEF 2/2016", "", "Eve", "", "",
+            "Carol", "2017-01-01"))
+        fmsdb.save_record("court_going", ("CRB 8/2017", "", "", "", "",
+            "2017-05-06", "", "Hearing"))
+        fmsdb.save_record("files_sent_to_dpp", dpp("GEF 2/2016", "CRB 8/2017"))
+        columns, rows = fmsdb.file_history("GEF 2/2016")
+        self.assertEqual(len(rows), 3)
+        self.assertIsNotNone(fmsdb.find_record("court_going", "CRB 8/2017"))
+
+
+if __name__ == "__main__":
+    unittest.main()
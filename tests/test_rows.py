@@ -0,0 +1,83 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+import fmsdb
+
+
+def putaway(n, suspect, day):
+    return ("GEF %d/2016" % n, "", "Alice", suspect, "Theft", "Shelf 1",
+        "Open", "2017-03-%02d" % day)
+
+
+class RowSourceTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"))
+        fmsdb.migrate()
+        for n, suspect in enumerate(["Ben", "Dan", "Ben", "Ann", "Cat", "Dan"]):
+            fmsdb.save_record("putaway", putaway(n, suspect, n + 1))
+        with fmsdb.Connection() as conn:
+            conn.execute("UPDATE files SET SUSPECT = NULL"
+                " WHERE REF IN ('GEF 1/2016', 'GEF 4/2016')")
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def rows(self, **order):
+        SQL, params = fmsdb.date_range_query("PUT AWAY FILES",
+            datetime.date(2017, 1, 1), datetime.date(2018, 1, 1), True)
+        rows = fmsdb.RowSource(SQL, params, 2)
+        return rows.sorted(**order) if order else rows
+
+    def read_paused(self, rows):
+        # One batch at a time, pausing between each
+        while not rows.exhausted:
+            rows.pause()
+            rows.fetch(len(rows) + 1)
+        return [row[0] for row in rows]
+
+    def test_paused_reads_match_a_single_read(self):
+        for order in [{}, {"column": "SUSPECT"},
+                {"column": "SUSPECT", "descending": True}]:
+            rows = self.rows(**order)
+            self.assertNotIn("ROW_KEY", rows.columns)
+            paused = self.read_paused(rows)
+            whole = self.rows(**order)
+            whole.fetch(float("inf"))
+            self.assertEqual(paused, [row[0] for row in whole])
+            self.assertEqual(len(set(paused)), 6)
+
+    def test_resume_after_changes(self):
+        rows = self.rows(column="SUSPECT", descending=True)
+        read = [row[0] for row in rows]
+        rows.pause()
+
+        # A file sorting before those read is not seen; one after is
+        fmsdb.save_record("putaway", putaway(10, "Zed", 20))
+        fmsdb.save_record("putaway", putaway(11, "Aaron", 21))
+        fmsdb.delete_record("putaway", "GEF 3/2016")
+        rows.fetch(float("inf"))
+
+        refs = [row[0] for row in rows]
+        self.assertEqual(refs[:len(read)], read)
+        self.assertEqual(len(refs), len(set(refs)))
+        self.assertNotIn("GEF 10/2016", refs)
+        self.assertIn("GEF 11/2016", refs)
+        self.assertNotIn("GEF 3/2016", refs)
+
+    def test_export_leaves_out_the_key(self):
+        path = os.path.join(self.dir, "rows.csv")
+        rows = self.rows(column="SUSPECT", descending=True)
+        rows.export(path)
+        with open(path, encoding="utf-8") as f:
+            lines = f.read().splitlines()
+        self.assertNotIn("ROW_KEY", lines[0])
+        self.assertEqual(len(lines), 7)
+
+
+if __name__ == "__main__":
+    unittest.main()
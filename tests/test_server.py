@@ -0,0 +1,97 @@
+import asyncio
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import fmsdb
+import fmsserver
+
+
+class DroppedConnection:
+    # A kept connection the server has since closed
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, *args):
+        self.requests += 1
+        raise BrokenPipeError("closed by the server")
+
+    def close(self):
+        pass
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"))
+        fmsdb.migrate()
+        for n in range(30):
+            fmsdb.save_record("putaway", ("GEF %d/2016" % n, "", "Alice",
+                "S%02d" % (n % 7), "Theft", "Shelf 1", "Open",
+                "2017-03-%02d" % (n % 28 + 1)))
+
+        self.server = fmsserver.Server(port=0)
+        ready = threading.Event()
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+        asyncio.run_coroutine_threadsafe(
+            self.server.serve(lambda server: ready.set()), self.loop)
+        ready.wait()
+        self.client = fmsserver.Client("127.0.0.1:%d" % self.server.port)
+
+    def tearDown(self):
+        async def stop():
+            tasks = asyncio.all_tasks() - {asyncio.current_task()}
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        asyncio.run_coroutine_threadsafe(stop(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+        self.server.readers.shutdown()
+        self.server.writer.shutdown()
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def period_files(self):
+        return self.client.period_files("PUT AWAY FILES",
+            datetime.date(2017, 1, 1), datetime.date(2018, 1, 1))
+
+    def test_period_files_are_read_a_batch_at_a_time(self):
+        total, columns, rows = self.period_files()
+        rows.batch = 8
+        self.assertEqual(total, 30)
+
+        sorted_rows = rows.sorted("SUSPECT", True)
+        self.assertEqual(len(sorted_rows), 8)
+        sorted_rows.fetch(float("inf"))
+        self.assertEqual(len(set(sorted_rows.rows)), 30)
+        suspects = [row[columns.index("SUSPECT")] for row in sorted_rows]
+        self.assertEqual(suspects, sorted(suspects, reverse=True))
+
+        path = os.path.join(self.dir, "rows.csv")
+        sorted_rows.export(path)
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(len(f.read().splitlines()), 31)
+
+    def test_reads_are_sent_again_on_a_dropped_connection(self):
+        self.client.local.conn = DroppedConnection()
+        self.assertEqual(self.client.find_record("putaway",
+            "GEF 1/2016")["SUSPECT"], "S01")
+
+    def test_writes_are_not_sent_again(self):
+        dropped = self.client.local.conn = DroppedConnection()
+        with self.assertRaises(ConnectionError):
+            self.client.delete_record("putaway", "GEF 1/2016")
+        self.assertEqual(dropped.requests, 1)
+        self.assertIsNotNone(fmsdb.find_record("putaway", "GEF 1/2016"))
+
+
+if __name__ == "__main__":
+    unittest.main()
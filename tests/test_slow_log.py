@@ -0,0 +1,43 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import fmsdb
+
+
+class SlowLogTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.log = os.path.join(self.dir, "slow.log")
+        self.profile = dict(fmsdb.manager.profile)
+        fmsdb.manager.configure(os.path.join(self.dir, "fms.db"),
+            slow_query_ms=0, slow_query_log=self.log)
+        fmsdb.migrate()
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        fmsdb.manager.profile = self.profile
+        for handler in fmsdb.query_stats.log.handlers[:]:
+            fmsdb.query_stats.log.removeHandler(handler)
+            handler.close()
+        fmsdb.query_stats.log_path = None
+        shutil.rmtree(self.dir)
+
+    def find(self):
+        fmsdb.find_record("putaway", "GEF 1/2017 Alice")
+        with open(self.log, encoding="utf-8") as log:
+            return log.read()
+
+    def test_values_are_left_out(self):
+        text = self.find()
+        self.assertIn("parameters: 1 (str)", text)
+        self.assertNotIn("Alice", text)
+
+    def test_values_logged_when_asked(self):
+        fmsdb.manager.profile["slow_query_values"] = True
+        self.assertIn("GEF 1/2017 Alice", self.find())
+
+
+if __name__ == "__main__":
+    unittest.main()
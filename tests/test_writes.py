@@ -0,0 +1,132 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+
+import fmsdb
+
+
+def putaway(n):
+    return ("GEF %d/2016" % n, "", "Alice", "Ben", "Theft", "Shelf 1", "Open",
+        "2017-03-04")
+
+
+def refs():
+    with fmsdb.Connection() as conn:
+        return {r[0] for r in conn.execute("SELECT REF FROM files")}
+
+
+class WriteQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "fms.db")
+        fmsdb.manager.configure(self.path)
+        fmsdb.migrate()
+        self.writes = fmsdb.WriteQueue(backoff=0.05, retries=5)
+
+    def tearDown(self):
+        fmsdb.manager.close()
+        shutil.rmtree(self.dir)
+
+    def submit(self, func, *args):
+        # Runs func through the queue on a thread of its own; the outcome
+        # is kept as ("ok", result) or ("error", exception)
+        outcome = []
+
+        def run():
+            try:
+                outcome.append(("ok", self.writes.run(func, *args)))
+            except Exception as e:
+                outcome.append(("error", e))
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, outcome
+
+    def test_a_failing_write_is_undone_alone(self):
+        started, release = threading.Event(), threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        blocker, _ = self.submit(block)
+        started.wait()
+
+        def failing():
+            with fmsdb.Connection() as conn:
+                conn.execute("INSERT INTO files (REF) VALUES ('GEF 9/2016')")
+            raise ValueError("refused")
+
+        # Queued while the writer is busy, so committed as one batch
+        first = self.submit(fmsdb.save_now, "putaway", putaway(1))
+        failed = self.submit(failing)
+        second = self.submit(fmsdb.save_now, "putaway", putaway(2))
+        while self.writes.pending.qsize() < 3:
+            time.sleep(0.01)
+        release.set()
+        for thread, _ in (first, failed, second):
+            thread.join()
+        blocker.join()
+
+        self.assertEqual(first[1][0][0], "ok")
+        self.assertEqual(second[1][0][0], "ok")
+        self.assertEqual(failed[1][0][0], "error")
+        self.assertIsInstance(failed[1][0][1], ValueError)
+        self.assertEqual(refs(), {"GEF 1/2016", "GEF 2/2016"})
+        self.assertEqual(self.writes.commits, 2)
+        self.assertEqual(self.writes.writes, 4)
+
+    def lock_database(self):
+        # The writer gives up on the lock quickly, so the queue retries
+        self.addCleanup(fmsdb.manager.configure,
+            busy_timeout=fmsdb.manager.profile["busy_timeout"])
+        fmsdb.manager.configure(busy_timeout=10)
+        other = sqlite3.connect(self.path, isolation_level=None)
+        other.execute("BEGIN IMMEDIATE")
+        return other
+
+    def test_a_busy_batch_is_tried_again(self):
+        other = self.lock_database()
+        thread, outcome = self.submit(fmsdb.save_now, "putaway", putaway(1))
+        time.sleep(0.2)
+        other.rollback()
+        other.close()
+        thread.join()
+
+        self.assertEqual(outcome[0][0], "ok")
+        self.assertGreater(self.writes.retried, 0)
+        self.assertEqual(refs(), {"GEF 1/2016"})
+
+    def test_a_busy_batch_fails_after_its_retries(self):
+        self.writes.retries = 1
+        other = self.lock_database()
+        try:
+            with self.assertRaises(sqlite3.OperationalError) as caught:
+                self.writes.run(fmsdb.save_now, "putaway", putaway(1))
+            self.assertTrue(fmsdb.busy(caught.exception))
+        finally:
+            other.rollback()
+            other.close()
+        self.assertEqual(refs(), set())
+
+    def test_a_write_inside_the_callers_transaction(self):
+        # Run where it is called, and undone with the caller's work
+        with self.assertRaises(ZeroDivisionError):
+            with fmsdb.Connection() as conn:
+                conn.execute("INSERT INTO files (REF) VALUES ('GEF 9/2016')")
+                fmsdb.save_record("putaway", putaway(1))
+                self.assertEqual(refs(), {"GEF 1/2016", "GEF 9/2016"})
+                1 / 0
+        self.assertEqual(refs(), set())
+
+        with fmsdb.Connection() as conn:
+            fmsdb.save_record("putaway", putaway(1))
+        self.assertEqual(refs(), {"GEF 1/2016"})
+
+
+if __name__ == "__main__":
+    unittest.main()